@@ -0,0 +1,45 @@
+"""Benchmarks import time of the modules a CLI run or a test loads first.
+
+Every import is timed in a fresh interpreter. Run from the repository root:
+
+    python -m benchmarks.startup [--connect]
+
+With --connect, the time CloudFactory.connect_all takes to connect to all
+clouds is measured as well, which needs valid tokens.
+"""
+import subprocess
+import sys
+
+MODULES = [
+    'constants',
+    'cloud_io',
+    'file_models.file_piece',
+    'recovery_manager',
+    'file_models.sprinkle_file',
+]
+REPEAT = 5
+
+IMPORT_SNIPPET = "import time; start = time.time(); import {}; print(time.time() - start)"
+CONNECT_SNIPPET = ("import time; from cloud_io import CloudFactory; start = time.time(); "
+                   "CloudFactory.connect_all(); print(time.time() - start)")
+
+
+def time_snippet(snippet):
+    """Runs a snippet in a fresh interpreter, returns the seconds it printed."""
+    output = subprocess.check_output([sys.executable, '-c', snippet])
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    print('{:>30} {:>12} {:>12}'.format('module', 'best (s)', 'worst (s)'))
+    for module in MODULES:
+        timings = [time_snippet(IMPORT_SNIPPET.format(module)) for _ in xrange(REPEAT)]
+        print('{:>30} {:>12.4f} {:>12.4f}'.format(module, min(timings), max(timings)))
+
+    if '--connect' in sys.argv:
+        seconds = time_snippet(CONNECT_SNIPPET)
+        print('{:>30} {:>12.4f} {:>12.4f}'.format('connect_all', seconds, seconds))
+
+
+if __name__ == '__main__':
+    main()
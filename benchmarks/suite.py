@@ -0,0 +1,390 @@
+"""End-to-end benchmarks of the sprinkle pipeline against stand-in clouds.
+
+Synthetic files of the given sizes are sprinkled over three MemoryWriter or
+LocalWriter clouds. Every case and size runs in a fresh interpreter so peak
+RSS is measured per case. Run from the repository root:
+
+    python -m benchmarks.suite --sizes 64K,1M,64M --output results.json
+    python -m benchmarks.suite --compare old.json new.json
+
+The memory backend keeps every uploaded piece in RAM, use the local backend
+for multi-GB files.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+import metrics
+import piece_cache
+import recovery_manager
+import repair_queue
+from cloud_io import CloudFactory, LocalWriter, MemoryWriter
+from constants import CHUNK_SIZE
+from encryption import AesCoder
+from file_models.file_piece import FilePiece
+from file_models.sprinkle_file import SprinkleFile
+
+ENCRYPTION_KEY = "{:$^32}".format("B3NCHM@RK")
+CLOUD_NAMES = ['bench1', 'bench2', 'bench3']
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Seconds between two samples of the scratch directory size
+DISK_SAMPLE_INTERVAL = 0.05
+
+
+def parse_size(text):
+    """Parses sizes like 64K, 1M or 2G into bytes."""
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of the given values."""
+    ordered = sorted(values)
+    index = max(0, int(round(fraction * len(ordered) + 0.5)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def generate_file(path, size, compressible=0.5):
+    """Writes a synthetic file, the given fraction of every block compresses well."""
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    text = b'sprinkle the file over the clouds ' * (CHUNK_SIZE // 34 + 1)
+    with open(path, 'wb') as synthetic_file:
+        written = 0
+        while written < size:
+            block_size = min(CHUNK_SIZE, size - written)
+            text_size = int(block_size * compressible)
+            synthetic_file.write(text[:text_size] + os.urandom(block_size - text_size))
+            written += block_size
+    return path
+
+
+def directory_size(path):
+    """Total size of the files below a directory."""
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass  # removed while walking
+    return total
+
+
+class DiskSampler(threading.Thread):
+    """Samples the size of a directory in the background, keeps the peak."""
+
+    def __init__(self, path):
+        super(DiskSampler, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, directory_size(self.path))
+            self._stop_event.wait(DISK_SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, directory_size(self.path))
+
+
+def use_bench_clouds(backend, cloud_root, latency, bandwidth):
+    """Replaces the real clouds with fresh stand-in clouds."""
+    for name in list(CloudFactory.get_cloud_names()):
+        CloudFactory.unregister(name)
+    for name in CLOUD_NAMES:
+        if backend == 'local':
+            root = os.path.join(cloud_root, name)
+            shutil.rmtree(root, ignore_errors=True)
+            factory = partial(LocalWriter, root, name=name, latency=latency,
+                              bandwidth=bandwidth)
+        else:
+            factory = partial(MemoryWriter, name=name, latency=latency, bandwidth=bandwidth)
+        CloudFactory.register(name, factory)
+    # every run measures transfers from the clouds, not hits of the local cache
+    piece_cache.set_cache(None)
+
+
+class Case(object):
+    """A benchmarked operation, setup runs before every timed run."""
+
+    def __init__(self, source, workdir, options):
+        self.source = source
+        self.workdir = workdir
+        self.options = options
+
+    def scratch(self, name):
+        return os.path.join(self.workdir, name)
+
+    def setup(self):
+        pass
+
+    def run(self):
+        pass
+
+    def teardown(self):
+        for name in os.listdir(self.workdir):
+            os.remove(self.scratch(name))
+
+
+class SplitCase(Case):
+
+    def run(self):
+        recovery_manager.split_file(self.source, prefix=self.scratch('piece'), cleanup=False)
+
+
+class MergeCase(Case):
+
+    def setup(self):
+        self.pieces = recovery_manager.split_file(self.source, prefix=self.scratch('piece'),
+                                                  cleanup=False)
+
+    def run(self):
+        recovery_manager.merge_files(self.pieces, self.scratch('merged'), cleanup=False)
+
+
+class XorCase(Case):
+
+    def run(self):
+        with open(self.scratch('xored'), 'wb') as xor_file:
+            recovery_manager.xor_files(self.source, self.source, xor_file)
+
+
+class EncryptCase(Case):
+
+    def run(self):
+        AesCoder.encrypt_file(ENCRYPTION_KEY, self.source, self.scratch('encrypted'),
+                              cleanup=False)
+
+
+class DecryptCase(Case):
+
+    def setup(self):
+        AesCoder.encrypt_file(ENCRYPTION_KEY, self.source, self.scratch('encrypted'),
+                              cleanup=False)
+
+    def run(self):
+        AesCoder.decrypt_file(ENCRYPTION_KEY, self.scratch('encrypted'),
+                              self.scratch('decrypted'), cleanup=False)
+
+
+class UploadCase(Case):
+
+    def setup(self):
+        use_bench_clouds(**self.options)
+
+    def run(self):
+        SprinkleFile(self.source, encryption_key=ENCRYPTION_KEY).upload()
+
+
+class DownloadCase(Case):
+
+    def setup(self):
+        use_bench_clouds(**self.options)
+        uploaded = SprinkleFile(self.source, encryption_key=ENCRYPTION_KEY)
+        uploaded.upload()
+        self.metadata = uploaded.metadata
+
+    def run(self):
+        SprinkleFile(self.scratch('restored'), encryption_key=ENCRYPTION_KEY,
+                     metadata=self.metadata).download()
+
+
+class ReconstructCase(Case):
+
+    def setup(self):
+        use_bench_clouds(**self.options)
+        uploaded = SprinkleFile(self.source, encryption_key=ENCRYPTION_KEY)
+        uploaded.upload()
+        self.metadata = uploaded.metadata
+
+        lost_name = self.metadata["merge_order"][0]
+        lost_meta = self.metadata["pieces"][lost_name]
+        CloudFactory.get_cloud(lost_meta["cloud"]).delete(lost_meta["file_id"])
+        self.piece = FilePiece(lost_name, self.source, metadata=lost_meta)
+        # spooled pieces are removed once repaired
+        self.queue = repair_queue.RepairQueue(state_filename=None, spool_directory=self.workdir)
+
+    def run(self):
+        data = recovery_manager.rebuild(self.piece, self.metadata, ENCRYPTION_KEY)
+        self.queue.submit(self.source, self.metadata, self.piece.name, ENCRYPTION_KEY, data=data,
+                          on_repaired=partial(repair_queue.repoint, self.metadata["pieces"]))
+        if not self.queue.join():
+            raise Exception('The repair of {} failed!'.format(self.piece.name))
+
+
+CASES = OrderedDict([
+    ('split_file', SplitCase),
+    ('merge_files', MergeCase),
+    ('xor_files', XorCase),
+    ('aes_encrypt', EncryptCase),
+    ('aes_decrypt', DecryptCase),
+    ('sprinkle_upload', UploadCase),
+    ('sprinkle_download', DownloadCase),
+    ('reconstruct', ReconstructCase),
+])
+
+
+def run_case(name, source, size, repeat, options):
+    """Runs a case in this interpreter, returns its result record."""
+    workdir = tempfile.mkdtemp(prefix='sprinkle_bench_')
+    case = CASES[name](source, workdir, options)
+    timings = []
+    peak_disk = 0
+    stdout = sys.stdout
+    metrics.registry.reset()
+    try:
+        # the pipeline still reports progress on stdout
+        sys.stdout = open(os.devnull, 'w')
+        for _ in xrange(repeat):
+            case.setup()
+            sampler = DiskSampler(workdir)
+            sampler.start()
+            start = time.time()
+            case.run()
+            timings.append(time.time() - start)
+            sampler.stop()
+            peak_disk = max(peak_disk, sampler.peak)
+            case.teardown()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    median = percentile(timings, 0.5)
+    return OrderedDict([
+        ('case', name),
+        ('size', size),
+        ('repeat', repeat),
+        ('seconds', timings),
+        ('throughput_mib_s', size / float(UNITS['M']) / median if median else None),
+        ('p50', median),
+        ('p90', percentile(timings, 0.9)),
+        ('p99', percentile(timings, 0.99)),
+        ('peak_rss_kib', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        ('peak_temp_bytes', peak_disk),
+        ('stages', metrics.registry.snapshot()),
+    ])
+
+
+def git_commit():
+    """Commit the benchmarks run against, None outside a git checkout."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    """Runs every selected case and size in its own interpreter."""
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='sprinkle_data_')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    cloud_root = tempfile.mkdtemp(prefix='sprinkle_clouds_')
+
+    results = []
+    try:
+        for size_text in args.sizes.split(','):
+            size = parse_size(size_text)
+            source = generate_file(os.path.join(data_dir, 'synthetic_{}'.format(size)), size,
+                                   args.compressible)
+            for name in args.cases.split(','):
+                command = [sys.executable, '-m', 'benchmarks.suite', '--run-case', name,
+                           '--source', source, '--repeat', str(args.repeat),
+                           '--backend', args.backend, '--cloud-root', cloud_root,
+                           '--latency', str(args.latency), '--bandwidth', str(args.bandwidth)]
+                result = json.loads(subprocess.check_output(command).splitlines()[-1])
+                print('{case:>18} {size:>12} {p50:>10.4f}s {throughput_mib_s:>10.1f} MiB/s '
+                      '{peak_rss_kib:>10} KiB RSS {peak_temp_bytes:>12} B temp'.format(**result))
+                results.append(result)
+    finally:
+        shutil.rmtree(cloud_root, ignore_errors=True)
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = OrderedDict([
+        ('commit', git_commit()),
+        ('python', platform.python_version()),
+        ('timestamp', time.time()),
+        ('backend', args.backend),
+        ('latency', args.latency),
+        ('bandwidth', args.bandwidth),
+        ('results', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    return report
+
+
+def compare(old_path, new_path):
+    """Prints how the median time of every case changed between two reports."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old_report = json.load(old_file)
+        new_report = json.load(new_file)
+    old_results = dict(((result['case'], result['size']), result)
+                       for result in old_report['results'])
+
+    print('{} -> {}'.format(old_report.get('commit'), new_report.get('commit')))
+    for result in new_report['results']:
+        old = old_results.get((result['case'], result['size']))
+        if not old:
+            continue
+        change = (result['p50'] - old['p50']) / old['p50'] * 100 if old['p50'] else 0.0
+        print('{:>18} {:>12} {:>10.4f}s {:>10.4f}s {:>+8.1f}%'.format(
+            result['case'], result['size'], old['p50'], result['p50'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='64K,1M,16M')
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every cloud call')
+    parser.add_argument('--bandwidth', type=parse_size, default=0,
+                        help='bytes per second per cloud, 0 for unlimited')
+    parser.add_argument('--compressible', type=float, default=0.5,
+                        help='fraction of the synthetic data that compresses well')
+    parser.add_argument('--data-dir', help='keeps generated files for later runs')
+    parser.add_argument('--output', help='writes the JSON report to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    parser.add_argument('--cloud-root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.run_case:
+        options = dict(backend=args.backend, cloud_root=args.cloud_root,
+                       latency=args.latency, bandwidth=args.bandwidth or None)
+        result = run_case(args.run_case, args.source, os.path.getsize(args.source),
+                          args.repeat, options)
+        print(json.dumps(result))
+    else:
+        run_suite(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Benchmarks the XOR parity engine against the original per-byte loop.
+
+Run from the repository root:
+
+    python -m benchmarks.xor_parity
+"""
+import io
+import os
+import time
+
+import parity
+from constants import CHUNK_SIZE
+
+SIZES = [CHUNK_SIZE, 4 * CHUNK_SIZE, 16 * CHUNK_SIZE]
+
+# The per-byte loop gets painfully slow on large chunks
+LOOP_MAX_SIZE = 4 * CHUNK_SIZE
+REPEAT = 3
+
+
+def xor_loop(buf1, buf2):
+    """The original per-byte XOR loop from recovery_manager.xor_files."""
+    file1_bytes = bytearray(buf1)
+    file2_bytes = bytearray(buf2)
+    result = bytearray()
+    for i in xrange(len(file1_bytes)):
+        result.append(file1_bytes[i] ^ file2_bytes[i])
+    return bytes(result)
+
+
+def xor_streamed(buf1, buf2):
+    """XORs two buffers through the streaming parity engine."""
+    destination = io.BytesIO()
+    parity.xor_streams(io.BytesIO(buf1), io.BytesIO(buf2), destination)
+    return destination.getvalue()
+
+
+def best_time(func, *args):
+    """Returns the best wall clock time out of REPEAT runs."""
+    timings = []
+    for _ in xrange(REPEAT):
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    engines = [
+        ('loop', xor_loop),
+        ('xor_bytes', parity.xor_bytes),
+        ('xor_streams', xor_streamed),
+    ]
+    print('numpy available: {}'.format(parity.numpy is not None))
+    print('{:>12} {:>12} {:>12} {:>12}'.format('size', 'engine', 'seconds', 'MiB/s'))
+
+    for size in SIZES:
+        buf1 = os.urandom(size)
+        buf2 = os.urandom(size)
+        expected = parity.xor_bytes(buf1, buf2)
+
+        for name, engine in engines:
+            if engine is xor_loop and size > LOOP_MAX_SIZE:
+                continue
+            if engine(buf1, buf2) != expected:
+                raise Exception('{} produced a wrong result!'.format(name))
+            seconds = best_time(engine, buf1, buf2)
+            throughput = size / (1024.0 * 1024.0) / seconds if seconds else float('inf')
+            print('{:>12} {:>12} {:>12.4f} {:>12.1f}'.format(size, name, seconds, throughput))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Content defined chunking.
+
+Chunks are cut where a rolling hash of the last CDC_WINDOW_SIZE bytes has its
+low CDC_MASK_BITS bits all zero, so an insertion only changes the chunks around
+it instead of shifting every following chunk.
+"""
+import random
+
+from constants import CDC_MASK_BITS, CDC_MAX_SIZE, CDC_MIN_SIZE, CDC_WINDOW_SIZE
+
+try:
+    # numpy, required by requirements.txt, hashes whole blocks at once, the pure Python
+    # fallback only keeps chunking working where it could not be installed
+    import numpy
+except ImportError:
+    numpy = None
+
+# Random but fixed value for every byte, the rolling hash is a window sum of these
+_GEAR_STATE = random.Random(0x5EED)
+GEAR = [_GEAR_STATE.getrandbits(32) for _ in xrange(256)]
+
+MASK = (1 << CDC_MASK_BITS) - 1
+
+# Number of window positions hashed at once before looking for a cut
+SCAN_BLOCK_SIZE = 256 * 1024
+
+
+def _find_cut_numpy(data, start, end):
+    """Returns the first position in [start, end) whose window matches the mask."""
+    gear = numpy.array(GEAR, dtype=numpy.uint64)
+    for block_start in xrange(start, end, SCAN_BLOCK_SIZE):
+        block_end = min(end, block_start + SCAN_BLOCK_SIZE)
+        window = numpy.frombuffer(data, dtype=numpy.uint8,
+                                  count=block_end - block_start + CDC_WINDOW_SIZE - 1,
+                                  offset=block_start - CDC_WINDOW_SIZE + 1)
+        # a plain [0] would promote the sums to float64
+        sums = numpy.concatenate((numpy.zeros(1, dtype=numpy.uint64),
+                                  numpy.cumsum(gear[window], dtype=numpy.uint64)))
+        hashes = sums[CDC_WINDOW_SIZE:] - sums[:-CDC_WINDOW_SIZE]
+        matches = numpy.flatnonzero((hashes & MASK) == 0)
+        if len(matches):
+            return block_start + int(matches[0])
+    return None
+
+
+def _find_cut_python(data, start, end):
+    """Returns the first position in [start, end) whose window matches the mask."""
+    data = bytearray(data)
+    window_hash = sum(GEAR[byte] for byte in data[start - CDC_WINDOW_SIZE + 1:start + 1])
+    position = start
+    while True:
+        if window_hash & MASK == 0:
+            return position
+        position += 1
+        if position >= end:
+            return None
+        window_hash += GEAR[data[position]] - GEAR[data[position - CDC_WINDOW_SIZE]]
+
+
+def cut_point(data):
+    """Returns the length of the first chunk of the given data."""
+    if len(data) <= CDC_MIN_SIZE:
+        return len(data)
+
+    end = min(len(data), CDC_MAX_SIZE)
+    find_cut = _find_cut_numpy if numpy is not None else _find_cut_python
+    position = find_cut(data, CDC_MIN_SIZE, end)
+    return position + 1 if position is not None else end
+
+
+def iter_chunks(stream):
+    """Yields the offset and content of every chunk read from a stream."""
+    offset = 0
+    buffered = b''
+    eof = False
+    while True:
+        if not eof and len(buffered) < CDC_MAX_SIZE:
+            block = stream.read(CDC_MAX_SIZE)
+            eof = not block
+            buffered += block
+            continue
+        if not buffered:
+            break
+
+        length = cut_point(buffered)
+        yield offset, buffered[:length]
+        offset += length
+        buffered = buffered[length:]
@@ -1,28 +1,117 @@
+import binascii
+import hashlib
+import json
 import os
 import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from logging import debug, info
 
-import dropbox
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient import http, errors
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from boxsdk import DevelopmentClient
+from concurrent.futures import ThreadPoolExecutor
 
 from compression import unzip_file, zip_file
 from constants import *
 from encryption import AesCoder
+from retry import RetryingWriter
+
+
+class InjectedCloudError(Exception):
+    """Failure injected by a simulated cloud, behaves like a provider side 503."""
+
+    status = 503
+
+
+class CloudHTTPError(Exception):
+    """Failed raw HTTP request to a provider, carries its status and Retry-After."""
+
+    def __init__(self, message, response):
+        super(CloudHTTPError, self).__init__(message)
+        self.status = response.status
+        # httplib2 responses are dicts of the headers
+        self.headers = dict(response)
+
+
+class UploadSessions(object):
+    """Keeps the state of unfinished upload sessions so retried uploads resume them.
+
+    Sessions are keyed by cloud, name, size and SHA-1 of the content, a session
+    is only resumed to upload the very same bytes. Pieces are encrypted with a
+    fresh IV every time they are encoded, so only retries within a process send
+    the same bytes again and sessions are not persisted. Sessions not saved for ttl
+    seconds belong to uploads given up on and are dropped.
+    """
+
+    def __init__(self, ttl=UPLOAD_SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def _expire(self):
+        expired_at = time.time() - self.ttl
+        for key, session in self._sessions.items():
+            if session['saved_at'] < expired_at:
+                del self._sessions[key]
+
+    def get(self, key):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(key)
+            return dict(session) if session else None
+
+    def save(self, key, session):
+        with self._lock:
+            session = dict(session)
+            session['saved_at'] = time.time()
+            self._sessions[key] = session
+
+    def drop(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+
+def stream_digest(stream):
+    """Returns the size and SHA-1 hex digest of a seekable stream, rewinds it."""
+    sha1 = hashlib.sha1()
+    size = 0
+    stream.seek(0)
+    while True:
+        block = stream.read(UPLOAD_CHUNK_SIZE)
+        if not block:
+            break
+        sha1.update(block)
+        size += len(block)
+    stream.seek(0)
+    return size, sha1.hexdigest()
 
 
 class CloudWriter(object):
 
     BASE_FOLDER = 'private_files'
 
+    # Streams larger than this many bytes are uploaded in resumable sessions
+    RESUMABLE_THRESHOLD = UPLOAD_CHUNK_SIZE
+    # Size of the chunks sent in a resumable session
+    UPLOAD_CHUNK_SIZE = UPLOAD_CHUNK_SIZE
+    # Size of the chunks downloads are streamed in
+    DOWNLOAD_CHUNK_SIZE = DOWNLOAD_CHUNK_SIZE
+    sessions = UploadSessions()
+
     def __init__(self):
         self.name = BASE_CLOUD
         self.creds = None
         self.service = None
         self.tokens = {}
+        # retry.RetryPolicy of the calls the writer makes on its own, set by RetryingWriter
+        self.retry_policy = None
+
+        # listing of the base folder, by id and by name
+        self._listing_lock = threading.Lock()
+        self._listed_at = None
+        self._entries_by_id = {}
+        self._entries_by_name = {}
 
     def setup_access(self):
         info('Setting up access for {}...'.format(self.name))
@@ -42,23 +131,155 @@ class CloudWriter(object):
         if cleanup:
             os.remove(path)
 
+    def upload_stream(self, name, stream, mime_type='application/zip'):
+        """Uploads the content of a readable stream without touching the disk."""
+        pass
+
+    def is_resumable(self, stream):
+        """Tells if a seekable stream is large enough for a resumable upload."""
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(position)
+        return size > self.RESUMABLE_THRESHOLD
+
+    def upload_resumable(self, name, stream, mime_type='application/zip'):
+        """Uploads a seekable stream chunk by chunk in an upload session.
+
+        The session state is saved after every chunk, a retry uploading the same
+        content after an interruption resumes at the last committed offset.
+        """
+        size, digest = stream_digest(stream)
+        key = (self.name, name, size, digest)
+        session = self.sessions.get(key)
+        if session is not None:
+            session = self._resume_session(session)
+            if session is None:
+                debug('Upload session of {} expired, starting over'.format(name))
+        if session is None:
+            session = self._start_session(name, size, mime_type)
+            session.update({'size': size, 'sha1': digest, 'offset': 0})
+            self.sessions.save(key, session)
+        else:
+            debug('Resuming upload of {} at {}/{}'.format(name, session['offset'], size))
+
+        while session['offset'] < size:
+            stream.seek(session['offset'])
+            chunk = stream.read(session.get('chunk_size', self.UPLOAD_CHUNK_SIZE))
+            session['offset'] = self._append_chunk(session, chunk)
+            self.sessions.save(key, session)
+
+        file_id = self._finish_session(session, name)
+        self.sessions.drop(key)
+        self._remember(file_id, name)
+        return file_id
+
+    def _start_session(self, name, size, mime_type):
+        """Opens an upload session, returns its state as a picklable dict."""
+        raise Exception('Resumable uploads are not supported by {}'.format(self.name))
+
+    def _resume_session(self, session):
+        """Brings a saved session up to date with the cloud, None once it expired."""
+        return session
+
+    def _append_chunk(self, session, chunk):
+        """Sends a chunk at the session offset, returns the new committed offset."""
+        pass
+
+    def _finish_session(self, session, name):
+        """Commits a fully sent session, returns the file id."""
+        pass
+
     def get(self, content):
         pass
 
-    def download(self, file_id, local_file_handle):
-        print 'Downloading file with id {}...'.format(file_id)
+    def free_space(self):
+        """Returns the bytes still free on the cloud, None when unknown."""
+        return None
+
+    def download(self, file_id, local_file_handle, offset=0, length=None, chunk_size=None):
+        """Streams a file, or length bytes of it from offset, into a writable handle.
+
+        At most chunk_size bytes of the response are held in memory at once.
+        """
+        debug('Downloading file with id {}...'.format(file_id))
 
     def delete(self, file_id):
-        print('Deleting file with path {}'.format(file_id))
+        debug('Deleting file with path {}'.format(file_id))
+        self._forget(file_id)
 
-    def list(self):
+    def list(self, folder_id=None, silent=False):
         pass
 
+    def list_base_folder(self):
+        """Lists every file in the base folder."""
+        return self.list(silent=True) or []
+
+    def _call(self, operation, func, tokens=1):
+        """Runs a call to the cloud through the retry policy, taking tokens of its rate."""
+        if self.retry_policy is None:
+            return func()
+        return self.retry_policy.call(operation, func, tokens=tokens)
+
+    def _listing(self):
+        """Returns the cached listing maps, listing the cloud again once expired."""
+        with self._listing_lock:
+            if self._listed_at is None or time.time() - self._listed_at > LISTING_TTL:
+                entries = self._call('list_base_folder', self.list_base_folder)
+                self._entries_by_id = dict((entry['id'], entry) for entry in entries)
+                self._entries_by_name = dict((entry['name'], entry) for entry in entries)
+                self._listed_at = time.time()
+            return self._entries_by_id, self._entries_by_name
+
+    def lookup(self, file_id):
+        """Returns the cached listing entry of a file id, None if there is none."""
+        return self._listing()[0].get(file_id)
+
+    def find(self, name):
+        """Returns the cached listing entry of a file name, None if there is none."""
+        return self._listing()[1].get(name)
+
+    def find_prefixed(self, prefix):
+        """Returns the cached listing entries of the file names starting with prefix."""
+        return [entry for name, entry in self._listing()[1].items() if name.startswith(prefix)]
+
+    def exists_many(self, file_ids):
+        """Checks which of the given files exist, returns a map of file id to bool.
+
+        The default implementation answers from a single listing of the base folder.
+        """
+        entries_by_id = self._listing()[0]
+        return dict((file_id, file_id in entries_by_id) for file_id in file_ids)
+
+    def invalidate_listing(self):
+        """Makes the next lookup list the cloud again."""
+        with self._listing_lock:
+            self._listed_at = None
+
+    def _remember(self, file_id, name):
+        """Adds an uploaded file to the cached listing."""
+        with self._listing_lock:
+            if self._listed_at is not None:
+                entry = {'id': file_id, 'name': name}
+                self._entries_by_id[file_id] = entry
+                self._entries_by_name[name] = entry
+
+    def _forget(self, file_id):
+        """Drops a deleted file from the cached listing."""
+        with self._listing_lock:
+            entry = self._entries_by_id.pop(file_id, None)
+            if entry and self._entries_by_name.get(entry['name']) is entry:
+                del self._entries_by_name[entry['name']]
+
 
 class GDriveWriter(CloudWriter):
 
     SCOPES = ['https://www.googleapis.com/auth/drive']
 
+    # Drive accepts at most 100 calls per batch request
+    BATCH_SIZE = 100
+    UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id'
+
     def __init__(self):
         super(GDriveWriter, self).__init__()
         self.name = GOOGLE_DRIVE
@@ -67,13 +288,28 @@ class GDriveWriter(CloudWriter):
             'credentials': 'tokens/{}_credentials.json'.format(self.name)
         }
         self.parent_folder_id = None
+        self._local = threading.local()
 
         self.setup_access()
         self.connect()
 
+    def _http(self):
+        """Returns an authorized http client owned by the calling thread.
+
+        httplib2 is not thread safe, so every worker thread gets its own.
+        """
+        http_client = getattr(self._local, 'http', None)
+        if http_client is None:
+            import google_auth_httplib2
+            import httplib2
+            http_client = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http_client
+        return http_client
+
     def setup_access(self):
         super(GDriveWriter, self).setup_access()
         if not self.creds:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             credentials_file = self.tokens['credentials']
             flow = InstalledAppFlow.from_client_secrets_file(credentials_file,
                                                              GDriveWriter.SCOPES)
@@ -84,6 +320,7 @@ class GDriveWriter(CloudWriter):
 
     def connect(self):
         super(GDriveWriter, self).connect()
+        from googleapiclient.discovery import build
         self.service = build('drive', 'v3', credentials=self.creds, cache_discovery=False)
 
         # load private_files folder
@@ -91,15 +328,19 @@ class GDriveWriter(CloudWriter):
             'name': CloudWriter.BASE_FOLDER,
             'mimeType': 'application/vnd.google-apps.folder'
         }
-        self.parent_folder_id = next((file_obj['id'] for file_obj in self.list(silent=True)
-                                      if parent_folder['name'] == file_obj['name']), None)
+        # ask for the folder itself, listing every file of the Drive would take long
+        query = "name = '{name}' and mimeType = '{mimeType}' and trashed = false".format(
+            **parent_folder)
+        folders = self._call('list', lambda: self.service.files().list(
+            q=query, fields='files(id)', pageSize=1).execute(http=self._http()))
+        self.parent_folder_id = next((folder['id'] for folder in folders.get('files', [])), None)
         if not self.parent_folder_id:
             self.parent_folder_id = self.service.files().create(
-                body=parent_folder, fields='id').execute()
+                body=parent_folder, fields='id').execute(http=self._http())['id']
 
     def upload(self, name, path, mime_type='application/zip', parent_id=None,
                metadata=None, cleanup=False):
-        print 'Uploading {}...'.format(path)
+        debug('Uploading {}...'.format(path))
         if metadata:
             metadata.update({'name': name})
         else:
@@ -110,45 +351,180 @@ class GDriveWriter(CloudWriter):
         else:
             metadata['parents'] = [self.parent_folder_id]
 
+        if os.path.getsize(path) > self.RESUMABLE_THRESHOLD:
+            with open(path, 'rb') as file_handle:
+                file_id = self.upload_resumable(name, file_handle, mime_type)
+            super(GDriveWriter, self).upload(name, path, cleanup=cleanup)
+            return file_id
+
+        from googleapiclient.http import MediaFileUpload
         media = MediaFileUpload(path, mimetype=mime_type)
-        file = self.service.files().create(body=metadata, media_body=media, fields='id').execute()
+        file = self.service.files().create(body=metadata, media_body=media,
+                                           fields='id').execute(http=self._http())
         debug('File ID: {}'.format(file.get('id')))
         super(GDriveWriter, self).upload(name, path, cleanup=cleanup)
+        self._remember(file["id"], name)
+        return file["id"]
+
+    def upload_stream(self, name, stream, mime_type='application/zip'):
+        debug('Uploading {}...'.format(name))
+        if self.is_resumable(stream):
+            return self.upload_resumable(name, stream, mime_type)
+        metadata = {'name': name, 'parents': [self.parent_folder_id]}
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(stream, mimetype=mime_type)
+        file = self.service.files().create(body=metadata, media_body=media,
+                                           fields='id').execute(http=self._http())
+        debug('File ID: {}'.format(file.get('id')))
+        self._remember(file["id"], name)
         return file["id"]
 
+    def _start_session(self, name, size, mime_type):
+        headers = {'Content-Type': 'application/json; charset=UTF-8',
+                   'X-Upload-Content-Type': mime_type,
+                   'X-Upload-Content-Length': str(size)}
+        body = json.dumps({'name': name, 'parents': [self.parent_folder_id]})
+        response, content = self._http().request(self.UPLOAD_URL, method='POST',
+                                                 body=body, headers=headers)
+        if response.status != 200:
+            raise CloudHTTPError('Could not start upload session for {}: {} {}'.format(
+                name, response.status, content), response)
+        return {'uri': response['location']}
+
+    def _session_offset(self, session, response, content):
+        """Reads the committed offset off a session response, None if it expired."""
+        if response.status in (200, 201):
+            session['file_id'] = json.loads(content)['id']
+            return session['size']
+        if response.status == 308:
+            # Range: bytes=0-N holds the bytes received so far
+            received = response.get('range')
+            return int(received.rsplit('-', 1)[1]) + 1 if received else 0
+        if response.status in (404, 410):
+            return None
+        raise CloudHTTPError('Upload session failed: {} {}'.format(response.status, content),
+                             response)
+
+    def _resume_session(self, session):
+        headers = {'Content-Range': 'bytes */{}'.format(session['size']),
+                   'Content-Length': '0'}
+        response, content = self._http().request(session['uri'], method='PUT', body='',
+                                                 headers=headers)
+        offset = self._session_offset(session, response, content)
+        if offset is None:
+            return None
+        session['offset'] = offset
+        return session
+
+    def _append_chunk(self, session, chunk):
+        start = session['offset']
+        headers = {'Content-Range': 'bytes {}-{}/{}'.format(start, start + len(chunk) - 1,
+                                                            session['size']),
+                   'Content-Length': str(len(chunk))}
+        response, content = self._http().request(session['uri'], method='PUT', body=chunk,
+                                                 headers=headers)
+        offset = self._session_offset(session, response, content)
+        if offset is None:
+            raise Exception('Upload session {} expired'.format(session['uri']))
+        return offset
+
+    def _finish_session(self, session, name):
+        # Drive commits the file along with its last chunk
+        debug('File ID: {}'.format(session['file_id']))
+        return session['file_id']
+
     def delete(self, file_id):
         super(GDriveWriter, self).delete(file_id)
-        self.service.files().delete(fileId=file_id).execute()
+        self.service.files().delete(fileId=file_id).execute(http=self._http())
 
     def get(self, file_id):
         """ Print a file's metadata. """
-        return self.service.files().get(fileId=file_id).execute()
-
-    def download(self, file_id, local_file_handle):
+        entry = self.lookup(file_id)
+        if entry:
+            return entry
+        return self._call('get', lambda: self.service.files().get(fileId=file_id)
+                          .execute(http=self._http()))
+
+    def free_space(self):
+        quota = self.service.about().get(fields='storageQuota').execute(
+            http=self._http())['storageQuota']
+        if 'limit' not in quota:
+            return None  # unlimited storage
+        return int(quota['limit']) - int(quota['usage'])
+
+    def exists_many(self, file_ids):
+        """ Checks files with batched metadata requests. """
+        from googleapiclient import errors
+        found = {}
+        failures = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                found[request_id] = not response.get('trashed', False)
+            elif isinstance(exception, errors.HttpError) and exception.resp.status == 404:
+                found[request_id] = False
+            else:
+                failures.append(exception)
+
+        file_ids = list(set(file_ids))
+        for start in xrange(0, len(file_ids), self.BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            batch_ids = file_ids[start:start + self.BATCH_SIZE]
+            for file_id in batch_ids:
+                batch.add(self.service.files().get(fileId=file_id, fields='id, trashed'),
+                          request_id=file_id)
+            # every request of a batch counts against the rate limit of Drive
+            self._call('exists_many', lambda: batch.execute(http=self._http()),
+                       tokens=len(batch_ids))
+
+        if failures:
+            raise failures[0]
+        return found
+
+    def download(self, file_id, local_file_handle, offset=0, length=None, chunk_size=None):
         """ Download a Drive file's content to the local filesystem """
-        request = self.service.files().get_media(fileId=file_id)
-        media_request = http.MediaIoBaseDownload(local_file_handle, request)
-
-        while True:
-            try:
-                download_progress, done = media_request.next_chunk()
-            except errors.HttpError as exc:
-                print('An error occurred: %s' % exc)
+        super(GDriveWriter, self).download(file_id, local_file_handle)
+        chunk_size = chunk_size or self.DOWNLOAD_CHUNK_SIZE
+        uri = self.service.files().get_media(fileId=file_id).uri
+        end = offset + length if length is not None else None
+
+        position = offset
+        while end is None or position < end:
+            last = position + chunk_size - 1
+            if end is not None:
+                last = min(last, end - 1)
+            response, content = self._http().request(
+                uri, headers={'Range': 'bytes={}-{}'.format(position, last)})
+            if response.status == 416:
+                # the range starts past the end of the file
                 return
-            if download_progress:
-                print('Download Progress: %d%%' % int(download_progress.progress() * 100))
-            if done:
-                print('Download Complete')
+            if response.status == 200:
+                # the whole file came back, the range was ignored
+                local_file_handle.write(content[position:end])
                 return
+            if response.status != 206:
+                raise CloudHTTPError('Download of {} failed: {} {}'.format(
+                    file_id, response.status, content), response)
+
+            local_file_handle.write(content)
+            position += len(content)
+            # Content-Range: bytes first-last/total
+            total = int(response['content-range'].rsplit('/', 1)[1])
+            end = total if end is None else min(end, total)
 
     def list(self, folder_id=None, silent=False):
         super(GDriveWriter, self).list()
-        kwargs = dict(fields="nextPageToken, files(id, name)")
+        kwargs = dict(fields="nextPageToken, files(id, name)", pageSize=1000)
         if folder_id:
-            kwargs['q'] = "'{}' in parents".format(folder_id)
+            kwargs['q'] = "'{}' in parents and trashed = false".format(folder_id)
 
-        results = self.service.files().list(**kwargs).execute()
-        items = results.get('files', [])
+        items = []
+        while True:
+            results = self.service.files().list(**kwargs).execute(http=self._http())
+            items.extend(results.get('files', []))
+            if not results.get('nextPageToken'):
+                break
+            kwargs['pageToken'] = results['nextPageToken']
 
         if not silent:
             if not items:
@@ -160,6 +536,9 @@ class GDriveWriter(CloudWriter):
                     print(u'{0} ({1})'.format(item['name'], item['id']))
         return items if items else []
 
+    def list_base_folder(self):
+        return self.list(folder_id=self.parent_folder_id, silent=True)
+
 
 class DropboxWriter(CloudWriter):
 
@@ -186,54 +565,141 @@ class DropboxWriter(CloudWriter):
 
     def connect(self):
         super(DropboxWriter, self).connect()
+        import dropbox
         self.service = dropbox.Dropbox(self.creds['access-token'])
 
     def upload(self, name, path, mime_type='application/zip', parent_id=None,
                metadata=None, cleanup=False):
-        print 'Uploading {}...'.format(path)
+        debug('Uploading {}...'.format(path))
         if metadata:
             metadata.update({'name': name})
         else:
             metadata = {'name': name}
 
         with open(path, 'rb') as file_handle:
-            file_meta = self.service.files_upload(file_handle.read(),
-                                                  '/{}/{}'.format(self.BASE_FOLDER, name))
+            file_id = self.upload_stream(name, file_handle, mime_type)
         super(DropboxWriter, self).upload(name, path, cleanup=cleanup)
+        return file_id
+
+    def upload_stream(self, name, stream, mime_type='application/zip'):
+        debug('Uploading {}...'.format(name))
+        if self.is_resumable(stream):
+            return self.upload_resumable(name, stream, mime_type)
+        file_meta = self.service.files_upload(stream.read(),
+                                              '/{}/{}'.format(self.BASE_FOLDER, name))
+        self._remember(file_meta.id, name)
         return file_meta.id
 
+    def _start_session(self, name, size, mime_type):
+        return {'id': self.service.files_upload_session_start(b'').session_id}
+
+    def _send(self, session, chunk):
+        """Appends a chunk, returns the committed offset, None if the session expired."""
+        import dropbox
+        cursor = dropbox.files.UploadSessionCursor(session['id'], session['offset'])
+        try:
+            self.service.files_upload_session_append_v2(chunk, cursor)
+        except dropbox.exceptions.ApiError as exc:
+            if exc.error.is_incorrect_offset():
+                return exc.error.get_incorrect_offset().correct_offset
+            if exc.error.is_not_found():
+                return None
+            raise
+        return session['offset'] + len(chunk)
+
+    def _resume_session(self, session):
+        # an empty append answers with the offset Dropbox actually holds
+        offset = self._send(session, b'')
+        if offset is None:
+            return None
+        session['offset'] = offset
+        return session
+
+    def _append_chunk(self, session, chunk):
+        offset = self._send(session, chunk)
+        if offset is None:
+            raise Exception('Upload session {} expired'.format(session['id']))
+        return offset
+
+    def _finish_session(self, session, name):
+        import dropbox
+        cursor = dropbox.files.UploadSessionCursor(session['id'], session['size'])
+        commit = dropbox.files.CommitInfo(path='/{}/{}'.format(self.BASE_FOLDER, name))
+        return self.service.files_upload_session_finish(b'', cursor, commit).id
+
     def delete(self, file_id):
         super(DropboxWriter, self).delete(file_id)
         self.service.files_delete_v2(file_id)
 
     def get(self, file_id):
         """ Print a file's metadata. """
-        # TODO find a better, faster way to do this
-        for entry in self.list():
-            if entry['id'] == file_id:
-                return entry
-        raise Exception('File with id {} Not found!'.format(file_id))
+        entry = self.lookup(file_id)
+        if entry:
+            return entry
+        import dropbox
+        try:
+            item = self._call('get', lambda: self.service.files_get_metadata(file_id))
+        except dropbox.exceptions.ApiError as exc:
+            if exc.error.is_path() and exc.error.get_path().is_not_found():
+                raise Exception('File with id {} Not found!'.format(file_id))
+            raise
+        return {'name': item.name, 'id': item.id,
+                'path': '/{}/{}'.format(self.BASE_FOLDER, item.name)}
+
+    def free_space(self):
+        usage = self.service.users_get_space_usage()
+        if usage.allocation.is_individual():
+            allocated = usage.allocation.get_individual().allocated
+        elif usage.allocation.is_team():
+            allocated = usage.allocation.get_team().allocated
+        else:
+            return None
+        return allocated - usage.used
 
-    def download(self, file_id, local_file_handle):
+    def download(self, file_id, local_file_handle, offset=0, length=None, chunk_size=None):
         """ Download a Drive file's content to the local filesystem """
         super(DropboxWriter, self).download(file_id, local_file_handle)
-        _, response = self.service.files_download(file_id)
-        local_file_handle.write(response.content)
+        if offset or length is not None:
+            # files_download takes no range, temporary links serve byte ranges
+            import requests
+            last = offset + length - 1 if length is not None else ''
+            link = self.service.files_get_temporary_link(file_id).link
+            response = requests.get(link, stream=True,
+                                    headers={'Range': 'bytes={}-{}'.format(offset, last)})
+            response.raise_for_status()
+        else:
+            _, response = self.service.files_download(file_id)
+
+        try:
+            for chunk in response.iter_content(chunk_size or self.DOWNLOAD_CHUNK_SIZE):
+                local_file_handle.write(chunk)
+        finally:
+            response.close()
 
     def list(self, folder_id=None, silent=False):
         super(DropboxWriter, self).list()
         if folder_id is None:
             folder_id = '/{}'.format(self.BASE_FOLDER)
+        result = self.service.files_list_folder(folder_id)
+        items = list(result.entries)
+        while result.has_more:
+            result = self.service.files_list_folder_continue(result.cursor)
+            items.extend(result.entries)
+
         files = [{'name': item.name, 'id': item.id,
                   'path': '/{}/{}'.format(self.BASE_FOLDER, item.name)}
-                 for item in self.service.files_list_folder(folder_id).entries]
+                 for item in items]
         return files
 
 
 class BoxWriter(CloudWriter):
 
+    RESUMABLE_THRESHOLD = max(UPLOAD_CHUNK_SIZE, BOX_MIN_CHUNKED_SIZE)
+
     def __init__(self):
+        super(BoxWriter, self).__init__()
         self.name = BOX
+        from boxsdk import DevelopmentClient
         self.service = DevelopmentClient()
         self.parent_folder = next(
             folder_info for folder_info in self.service.root_folder().get_items()
@@ -247,9 +713,54 @@ class BoxWriter(CloudWriter):
 
     def upload(self, name, path, mime_type='application/zip', parent_id=None,
                metadata=None, cleanup=False):
-        print 'Uploading {}...'.format(path)
-        file_object = self.parent_folder.upload(file_name=name, file_path=path)
+        debug('Uploading {}...'.format(path))
+        with open(path, 'rb') as file_handle:
+            file_id = self.upload_stream(name, file_handle, mime_type)
         super(BoxWriter, self).upload(name, path, cleanup=cleanup)
+        return file_id
+
+    def upload_stream(self, name, stream, mime_type='application/zip'):
+        debug('Uploading {}...'.format(name))
+        if self.is_resumable(stream):
+            return self.upload_resumable(name, stream, mime_type)
+        file_object = self.parent_folder.upload_stream(stream, name)
+        self._remember(file_object.id, name)
+        return file_object.id
+
+    def _start_session(self, name, size, mime_type):
+        upload_session = self.parent_folder.create_upload_session(file_size=size,
+                                                                  file_name=name)
+        # Box decides the part size, every part but the last must have it
+        return {'id': upload_session.id, 'chunk_size': upload_session.part_size, 'parts': []}
+
+    def _resume_session(self, session):
+        from boxsdk.exception import BoxAPIException
+        try:
+            parts = sorted(self.service.upload_session(session['id']).get_parts(),
+                           key=lambda part: part['offset'])
+        except BoxAPIException as exc:
+            if exc.status == 404:
+                return None
+            raise
+        # resume after the parts uploaded back to back from the start
+        session['parts'] = []
+        session['offset'] = 0
+        for part in parts:
+            if part['offset'] != session['offset']:
+                break
+            session['parts'].append(part)
+            session['offset'] += part['size']
+        return session
+
+    def _append_chunk(self, session, chunk):
+        part = self.service.upload_session(session['id']).upload_part_bytes(
+            chunk, session['offset'], session['size'])
+        session['parts'].append(part)
+        return session['offset'] + len(chunk)
+
+    def _finish_session(self, session, name):
+        file_object = self.service.upload_session(session['id']).commit(
+            content_sha1=binascii.unhexlify(session['sha1']), parts=session['parts'])
         return file_object.id
 
     def delete(self, file_id):
@@ -258,42 +769,289 @@ class BoxWriter(CloudWriter):
 
     def get(self, file_id):
         """ Print a file's metadata. """
-        file_object = self.service.file(file_id).get()
+        entry = self.lookup(file_id)
+        if entry:
+            return entry
+        file_object = self._call('get', lambda: self.service.file(file_id).get())
         return {'id': file_object.id, 'name': file_object.name}
 
-    def download(self, file_id, local_file_handle):
+    def free_space(self):
+        user = self.service.user().get(fields=['space_amount', 'space_used'])
+        return user.space_amount - user.space_used
+
+    def download(self, file_id, local_file_handle, offset=0, length=None, chunk_size=None):
         """ Download a Drive file's content to the local filesystem """
         super(BoxWriter, self).download(file_id, local_file_handle)
-        self.service.file(file_id).download_to(local_file_handle)
+        # the SDK streams the response into the handle in chunks of its own
+        byte_range = None
+        if offset or length is not None:
+            if length is None:
+                length = self.service.file(file_id).get(fields=['size']).size - offset
+            byte_range = (offset, offset + length - 1)
+        self.service.file(file_id).download_to(local_file_handle, byte_range=byte_range)
 
     def list(self, folder_id=None, silent=False):
         super(BoxWriter, self).list()
         files = [{'name': item.name, 'id': item.id}
-                 for item in self.parent_folder.get().item_collection['entries']]
+                 for item in self.parent_folder.get_items()]
         return files
 
 
+class MemoryWriter(CloudWriter):
+    """Keeps files in memory, a stand-in cloud for offline benchmarks.
+
+    latency seconds are added to every call, concurrent transfers share
+    bandwidth bytes per second and calls fail with InjectedCloudError at the
+    given failure_rate. A seed makes the failures reproducible. quota bytes
+    can be stored at most, unlimited by default.
+    """
+
+    def __init__(self, name=MEMORY, latency=0, bandwidth=None, failure_rate=0, seed=None,
+                 quota=None):
+        super(MemoryWriter, self).__init__()
+        self.name = name
+        self.quota = quota
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._storage_lock = threading.Lock()
+        # when the transfers already under way are done with the bandwidth
+        self._busy_until = 0
+        self._files = {}
+        # bytes received so far by open upload sessions
+        self._sessions = {}
+
+    def _simulate(self, size=0):
+        """Waits as long as the call would take and maybe fails it."""
+        now = time.time()
+        with self._storage_lock:
+            failed = self._random.random() < self.failure_rate
+            done_at = now
+            if self.bandwidth and size:
+                # transfers go one after the other through the link of the cloud
+                self._busy_until = max(now, self._busy_until) + size / float(self.bandwidth)
+                done_at = self._busy_until
+        delay = self.latency + done_at - now
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise InjectedCloudError('Injected failure on {}'.format(self.name))
+
+    def _write(self, file_id, name, data):
+        with self._storage_lock:
+            self._files[file_id] = (name, data)
+
+    def _size(self, file_id):
+        with self._storage_lock:
+            return len(self._files[file_id][1]) if file_id in self._files else None
+
+    def _read(self, file_id, offset=0, length=None):
+        with self._storage_lock:
+            data = self._files[file_id][1]
+        end = offset + length if length is not None else None
+        return data[offset:end]
+
+    def _remove(self, file_id):
+        with self._storage_lock:
+            self._files.pop(file_id, None)
+
+    def _names(self):
+        with self._storage_lock:
+            return dict((file_id, name) for file_id, (name, _) in self._files.items())
+
+    def upload(self, name, path, mime_type='application/zip', parent_id=None,
+               metadata=None, cleanup=False):
+        with open(path, 'rb') as file_handle:
+            file_id = self.upload_stream(name, file_handle, mime_type)
+        super(MemoryWriter, self).upload(name, path, cleanup=cleanup)
+        return file_id
+
+    def upload_stream(self, name, stream, mime_type='application/zip'):
+        if self.is_resumable(stream):
+            return self.upload_resumable(name, stream, mime_type)
+        data = stream.read()
+        self._simulate(len(data))
+        file_id = uuid.uuid4().hex
+        self._write(file_id, name, data)
+        self._remember(file_id, name)
+        return file_id
+
+    def _start_session(self, name, size, mime_type):
+        self._simulate()
+        session_id = uuid.uuid4().hex
+        with self._storage_lock:
+            self._sessions[session_id] = bytearray()
+        return {'id': session_id}
+
+    def _resume_session(self, session):
+        self._simulate()
+        with self._storage_lock:
+            received = self._sessions.get(session['id'])
+            if received is None:
+                return None
+            session['offset'] = len(received)
+        return session
+
+    def _append_chunk(self, session, chunk):
+        self._simulate(len(chunk))
+        with self._storage_lock:
+            received = self._sessions[session['id']]
+            del received[session['offset']:]
+            received.extend(chunk)
+            return len(received)
+
+    def _finish_session(self, session, name):
+        self._simulate()
+        with self._storage_lock:
+            data = bytes(self._sessions.pop(session['id']))
+        file_id = uuid.uuid4().hex
+        self._write(file_id, name, data)
+        return file_id
+
+    def delete(self, file_id):
+        self._simulate()
+        super(MemoryWriter, self).delete(file_id)
+        self._remove(file_id)
+
+    def get(self, file_id):
+        """ Print a file's metadata. """
+        entry = self.lookup(file_id)
+        if entry:
+            return entry
+
+        def get():
+            self._simulate()
+            name = self._names().get(file_id)
+            if name is None:
+                raise Exception('File with id {} Not found!'.format(file_id))
+            return {'id': file_id, 'name': name}
+        return self._call('get', get)
+
+    def free_space(self):
+        if self.quota is None:
+            return None
+        used = sum(self._size(file_id) or 0 for file_id in self._names())
+        return self.quota - used
+
+    def download(self, file_id, local_file_handle, offset=0, length=None, chunk_size=None):
+        size = self._size(file_id)
+        if size is None:
+            raise Exception('File with id {} Not found!'.format(file_id))
+        end = size if length is None else min(size, offset + length)
+        self._simulate(max(0, end - offset))
+
+        chunk_size = chunk_size or self.DOWNLOAD_CHUNK_SIZE
+        for position in xrange(offset, end, chunk_size):
+            local_file_handle.write(self._read(file_id, position,
+                                               min(chunk_size, end - position)))
+
+    def list(self, folder_id=None, silent=False):
+        super(MemoryWriter, self).list()
+        self._simulate()
+        return [{'id': file_id, 'name': name} for file_id, name in self._names().items()]
+
+
+class LocalWriter(MemoryWriter):
+    """Keeps files in a local directory, a stand-in cloud for offline benchmarks."""
+
+    INDEX_FILENAME = 'index.pickle'
+
+    def __init__(self, root, name=LOCAL, latency=0, bandwidth=None, failure_rate=0,
+                 seed=None, quota=None):
+        super(LocalWriter, self).__init__(name=name, latency=latency, bandwidth=bandwidth,
+                                          failure_rate=failure_rate, seed=seed, quota=quota)
+        self.folder = os.path.join(root, self.BASE_FOLDER)
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+        # names by file id, the content lives in a file named after the id
+        index_path = os.path.join(self.folder, self.INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as index_file:
+                self._files = pickle.load(index_file)
+
+    def _store_index(self):
+        with open(os.path.join(self.folder, self.INDEX_FILENAME), 'wb') as index_file:
+            pickle.dump(self._files, index_file)
+
+    def _write(self, file_id, name, data):
+        with open(os.path.join(self.folder, file_id), 'wb') as content_file:
+            content_file.write(data)
+        with self._storage_lock:
+            self._files[file_id] = name
+            self._store_index()
+
+    def _size(self, file_id):
+        with self._storage_lock:
+            if file_id not in self._files:
+                return None
+        return os.path.getsize(os.path.join(self.folder, file_id))
+
+    def _read(self, file_id, offset=0, length=None):
+        with open(os.path.join(self.folder, file_id), 'rb') as content_file:
+            content_file.seek(offset)
+            return content_file.read() if length is None else content_file.read(length)
+
+    def _remove(self, file_id):
+        with self._storage_lock:
+            if self._files.pop(file_id, None) is None:
+                return
+            self._store_index()
+        os.remove(os.path.join(self.folder, file_id))
+
+    def _names(self):
+        with self._storage_lock:
+            return dict(self._files)
+
+
 class CloudFactory(object):
 
-    CLOUDS = {
-        BOX: BoxWriter(),
-        DROPBOX: DropboxWriter(),
-        GOOGLE_DRIVE: GDriveWriter()
-    }
+    # Writer classes by cloud name, writers connect on first use
+    WRITERS = OrderedDict([
+        (BOX, BoxWriter),
+        (DROPBOX, DropboxWriter),
+        (GOOGLE_DRIVE, GDriveWriter)
+    ])
+    CLOUDS = {}
+    _locks = dict((name, threading.Lock()) for name in WRITERS)
+
+    @classmethod
+    def register(cls, name, writer_factory):
+        """Makes a cloud available, writer_factory creates its writer on first use."""
+        cls._locks.setdefault(name, threading.Lock())
+        with cls._locks[name]:
+            cls.WRITERS[name] = writer_factory
+            cls.CLOUDS.pop(name, None)
+
+    @classmethod
+    def unregister(cls, name):
+        """Stops using a cloud."""
+        cls.WRITERS.pop(name, None)
+        cls.CLOUDS.pop(name, None)
 
     @classmethod
     def get_cloud(cls, name):
-        if name in cls.CLOUDS:
-            return cls.CLOUDS[name]
-        raise Exception('Cloud {} not supported'.format(name))
+        if name not in cls.WRITERS:
+            raise Exception('Cloud {} not supported'.format(name))
+        with cls._locks[name]:
+            if name not in cls.CLOUDS:
+                cls.CLOUDS[name] = RetryingWriter(cls.WRITERS[name]())
+        return cls.CLOUDS[name]
+
+    @classmethod
+    def connect_all(cls):
+        """Connects to every cloud concurrently."""
+        with ThreadPoolExecutor(max(1, len(cls.WRITERS))) as pool:
+            return list(pool.map(cls.get_cloud, cls.get_cloud_names()))
 
     @classmethod
     def get_cloud_connections(cls):
-        return [cls.CLOUDS[name] for name in cls.CLOUDS]
+        return cls.connect_all()
 
     @classmethod
     def get_cloud_names(cls):
-        return cls.CLOUDS.keys()
+        return list(cls.WRITERS.keys())
 
 
 class Metadata(object):
@@ -307,14 +1065,7 @@ class Metadata(object):
     def load(cls):
         """Loads the metadata from the cloud."""
         for cloud_conn in CloudFactory.get_cloud_connections():
-
-            try:
-                metadata_file = next((file_object for file_object in cloud_conn.list()
-                                      if file_object['name'] == cls.CLOUD_ALIAS), None)
-            except TypeError:
-                # TODO: this is stupid
-                continue
-
+            metadata_file = cloud_conn.find(cls.CLOUD_ALIAS)
             if metadata_file:
                 with open(metadata_file['name'], 'wb') as zipped_file:
                     cloud_conn.download(metadata_file['id'], zipped_file)
@@ -342,18 +1093,23 @@ class Metadata(object):
         zip_file(encrypted_filename, dst_file=cls.CLOUD_ALIAS)
 
         for cloud_conn in CloudFactory.get_cloud_connections():
-            try:
-                metadata_file = next((file_object for file_object in cloud_conn.list()
-                                      if file_object['name'] == cls.CLOUD_ALIAS), None)
-            except TypeError:
-                # TODO: this is stupid
-                metadata_file = None
-
+            metadata_file = cloud_conn.find(cls.CLOUD_ALIAS)
             if metadata_file:
                 cloud_conn.delete(metadata_file['id'])
             cloud_conn.upload(cls.CLOUD_ALIAS, cls.CLOUD_ALIAS)
 
 
+class ChunkIndex(Metadata):
+    """Maps chunk digests to the pieces already holding them, for deduplication.
+
+    Every entry is {"piece": name, "pieces": {name: piece metadata}, "refs": count}
+    where pieces holds the piece along with the rest of its recovery group.
+    """
+
+    FILENAME = "chunk_index.pickle"
+    CLOUD_ALIAS = "{}.enc.zip".format(FILENAME)
+
+
 if __name__ == '__main__':
     drive = DropboxWriter()
     import pprint
@@ -1,6 +1,29 @@
+import io
 import os
+import zlib
 from zipfile import ZipFile
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Codec names
+STORE = 'store'
+AUTO = 'auto'
+
+# Codec auto mode picks for data that compresses well
+AUTO_CODEC = 'zlib-6'
+
+# Compressed to original size ratio above which auto mode stores data as is
+AUTO_MIN_RATIO = 0.9
+
+# Size in bytes of each sample auto mode compresses to estimate the ratio
+AUTO_SAMPLE_SIZE = 16 * 1024
+
 
 def zip_file(src_file, dst_file=None, cleanup=True):
     """Compresses a given file."""
@@ -21,3 +44,139 @@ def unzip_file(src_file, target_dir="./", cleanup=True):
         if cleanup:
             os.remove(src_file)
     return src_file[:-4]
+
+
+def zip_bytes(data, arcname):
+    """Compresses a buffer into an in-memory archive with a single member."""
+    archive = io.BytesIO()
+    with ZipFile(archive, "w") as myzip:
+        myzip.writestr(arcname, data)
+    return archive.getvalue()
+
+
+def unzip_bytes(data):
+    """Uncompresses the single member of an in-memory archive."""
+    with ZipFile(io.BytesIO(data), "r") as zip_ref:
+        return zip_ref.read(zip_ref.namelist()[0])
+
+
+class StoreCodec(object):
+    """Keeps data as is, for already compressed media."""
+
+    name = STORE
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def decompressor(self):
+        return None
+
+
+class ZlibCodec(object):
+    """Deflate at a given compression level."""
+
+    def __init__(self, level):
+        self.name = 'zlib-{}'.format(level)
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class LzmaCodec(object):
+    """LZMA with a given preset, slow but strong."""
+
+    def __init__(self, preset):
+        self.name = 'lzma-{}'.format(preset)
+        self.preset = preset
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """Makes a codec available by its name."""
+    CODECS[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    """Returns the codec registered under the given name."""
+    if name in CODECS:
+        return CODECS[name]
+    raise Exception('Codec {} not supported'.format(name))
+
+
+register_codec(StoreCodec())
+for _level in xrange(1, 10):
+    register_codec(ZlibCodec(_level))
+if lzma:
+    for _preset in xrange(0, 10):
+        register_codec(LzmaCodec(_preset))
+
+
+def choose_codec(data, codec_name=AUTO_CODEC):
+    """Picks codec_name if samples of the data compress well, STORE otherwise."""
+    if len(data) <= 3 * AUTO_SAMPLE_SIZE:
+        sample = data
+    else:
+        middle = (len(data) - AUTO_SAMPLE_SIZE) // 2
+        sample = b''.join([data[:AUTO_SAMPLE_SIZE],
+                           data[middle:middle + AUTO_SAMPLE_SIZE],
+                           data[-AUTO_SAMPLE_SIZE:]])
+    if not sample:
+        return STORE
+
+    ratio = len(zlib.compress(sample, 1)) / float(len(sample))
+    return codec_name if ratio < AUTO_MIN_RATIO else STORE
+
+
+def compress_bytes(data, codec_name=AUTO):
+    """Compresses a buffer, returns the name of the codec used and the result."""
+    if codec_name == AUTO:
+        codec_name = choose_codec(data)
+
+    compressed = get_codec(codec_name).compress(data)
+    if codec_name != STORE and len(compressed) >= len(data):
+        return STORE, data
+    return codec_name, compressed
+
+
+def decompress_bytes(data, codec_name):
+    """Uncompresses a buffer compressed with the named codec."""
+    return get_codec(codec_name).decompress(data)
+
+
+class DecompressingWriter(object):
+    """File-like sink uncompressing what is written to it into out_handle."""
+
+    def __init__(self, codec_name, out_handle):
+        self.out_handle = out_handle
+        self._decompressor = get_codec(codec_name).decompressor()
+
+    def write(self, data):
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        self.out_handle.write(data)
+
+    def close(self):
+        if self._decompressor is not None and hasattr(self._decompressor, 'flush'):
+            self.out_handle.write(self._decompressor.flush())
@@ -7,6 +7,8 @@ DROPBOX = 'dropbox'
 GOOGLE_DRIVE = 'gdrive'
 ONEDRIVE = 'onedrive'
 BOX = 'box'
+MEMORY = 'memory'
+LOCAL = 'local'
 
 # Get operations
 METADATA = 'meta'
@@ -17,3 +19,103 @@ DOWNLOAD = 'download'
 XOR = 'xor'
 DUP = 'dup'
 REGULAR = 'regular'
+PARITY = 'parity'
+
+# Size of split files in bytes
+CHUNK_SIZE = 1024 * 1024
+
+# Pipeline stage kinds
+CPU_STAGE = 'cpu'
+CLOUD_STAGE = 'cloud'
+
+# Number of concurrent transfers per cloud unless configured otherwise
+DEFAULT_CLOUD_CONCURRENCY = 4
+
+# Number of pieces a pipeline works on at once, bounds local disk usage
+MAX_PIECES_IN_FLIGHT = 16
+
+# Codec pieces are compressed with before encryption, see compression.CODECS
+DEFAULT_CODEC = 'auto'
+
+# Content defined chunking, chunks are cut where a rolling hash matches a mask
+CDC_MIN_SIZE = 256 * 1024
+CDC_MAX_SIZE = 4 * 1024 * 1024
+CDC_MASK_BITS = 20  # ~1 MiB chunks on average
+CDC_WINDOW_SIZE = 64
+
+# Seconds a cached cloud listing is trusted before listing the cloud again
+LISTING_TTL = 300
+
+# Seconds the free space reported by a cloud is trusted before asking again
+QUOTA_TTL = 300
+
+# Uploads larger than a chunk go through resumable upload sessions, chunk by chunk.
+# Drive wants multiples of 256 KiB, Dropbox of 4 MiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Box only accepts chunked uploads of files of at least 20 MB
+BOX_MIN_CHUNKED_SIZE = 20 * 1000 * 1000
+# Seconds an unfinished upload session is kept for retries to resume it
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# Downloads are streamed in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of decoded pieces a SprinkleReader keeps in memory
+READER_CACHE_PIECES = 16
+
+# Metadata store: local SQLite copy of the records and number of journal
+# segments in the clouds that triggers a compaction into a snapshot
+METADATA_DB = 'metadata.sqlite'
+METADATA_COMPACT_SEGMENTS = 64
+
+# Number of files a batch upload records in one metadata commit
+BATCH_CHECKPOINT_FILES = 256
+
+# Batch uploads pack files smaller than the threshold together into pieces of
+# up to PACK_SIZE bytes
+PACK_FILE_THRESHOLD = 256 * 1024
+PACK_SIZE = CHUNK_SIZE
+
+# Local cache of downloaded, still encrypted, pieces
+PIECE_CACHE_DIR = '.piece_cache'
+PIECE_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Retries of failed cloud calls: attempts in total, and bounds of the
+# exponential backoff between them in seconds
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+# Failures in a row after which a cloud is not called for BREAKER_COOLDOWN seconds
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+# Calls per second allowed by each provider, clouds not listed are not limited
+RATE_LIMITS = {
+    GOOGLE_DRIVE: 10,
+    DROPBOX: 10,
+    BOX: 15
+}
+
+# Hedged reads: a piece not downloaded within HEDGE_LATENCY_FACTOR times its
+# expected download time, and at least HEDGE_MIN_DELAY seconds, is rebuilt
+# from its siblings meanwhile, whichever is done first is used
+HEDGE_LATENCY_FACTOR = 3
+HEDGE_MIN_DELAY = 0.5
+
+# Repairs of lost pieces run in the background on REPAIR_WORKERS threads,
+# failed ones are retried up to REPAIR_ATTEMPTS times, after REPAIR_RETRY_DELAY
+# seconds doubling every time. Pending repairs and their pieces are kept in
+# REPAIR_STATE_FILE and REPAIR_SPOOL_DIR
+REPAIR_WORKERS = 2
+REPAIR_ATTEMPTS = 5
+REPAIR_RETRY_DELAY = 30
+REPAIR_STATE_FILE = 'repair_queue.pickle'
+REPAIR_SPOOL_DIR = '.repair_spool'
+
+# Scrubber: seconds between passes over every piece, file ids checked per
+# bulk existence call (a single Drive batch request), file ids checked per
+# second and bytes per second read to verify checksums, low enough to leave
+# the clouds to foreground transfers
+SCRUB_INTERVAL = 24 * 60 * 60
+SCRUB_BATCH_SIZE = 100
+SCRUB_CALLS_PER_SECOND = 2
+SCRUB_BYTES_PER_SECOND = 4 * 1024 * 1024
@@ -52,6 +52,38 @@ class AesCoder(object):
             os.remove(in_filename)
         return out_filename
 
+    @staticmethod
+    def encrypt_bytes(key, data):
+        """ Encrypts a buffer in memory, producing the same
+            layout encrypt_file writes to disk.
+        """
+        iv = os.urandom(16)
+        encryptor = AES.new(key, AES.MODE_CBC, iv)
+        header = struct.pack('<Q', len(data)) + iv
+
+        if len(data) % 16 != 0:
+            data += b' ' * (16 - len(data) % 16)
+        return header + encryptor.encrypt(data)
+
+    @staticmethod
+    def decrypt_bytes(key, data):
+        """ Decrypts a buffer produced by encrypt_bytes or
+            read from a file written by encrypt_file.
+        """
+        header_size = struct.calcsize('Q')
+        origsize = struct.unpack('<Q', data[:header_size])[0]
+        iv = data[header_size:header_size + 16]
+        decryptor = AES.new(key, AES.MODE_CBC, iv)
+        return decryptor.decrypt(data[header_size + 16:])[:origsize]
+
+    @staticmethod
+    def decryptor(key, out_handle):
+        """ Returns a file-like sink decrypting the layout of
+            encrypt_bytes as it is written in chunks of any size,
+            passing the plain content on to out_handle.
+        """
+        return DecryptingWriter(key, out_handle)
+
     @staticmethod
     def decrypt_file(key, in_filename, out_filename=None, chunksize=24*1024, cleanup=True):
         """ Decrypts a file using AES (CBC mode) with the
@@ -80,3 +112,40 @@ class AesCoder(object):
         if cleanup:
             os.remove(in_filename)
         return out_filename
+
+
+class DecryptingWriter(object):
+    """ Decrypts what is written to it, holding back at most
+        a partial AES block between writes.
+    """
+
+    HEADER_SIZE = struct.calcsize('Q') + 16
+
+    def __init__(self, key, out_handle):
+        self.key = key
+        self.out_handle = out_handle
+        self.received = 0
+        self._buffer = b''
+        self._decryptor = None
+        self._remaining = None
+
+    def write(self, data):
+        self.received += len(data)
+        self._buffer += data
+        if self._decryptor is None:
+            if len(self._buffer) < self.HEADER_SIZE:
+                return
+            self._remaining = struct.unpack('<Q', self._buffer[:8])[0]
+            self._decryptor = AES.new(self.key, AES.MODE_CBC, self._buffer[8:self.HEADER_SIZE])
+            self._buffer = self._buffer[self.HEADER_SIZE:]
+
+        usable = len(self._buffer) - len(self._buffer) % 16
+        if usable:
+            plain = self._decryptor.decrypt(self._buffer[:usable])[:self._remaining]
+            self._buffer = self._buffer[usable:]
+            self._remaining -= len(plain)
+            self.out_handle.write(plain)
+
+    def close(self):
+        if self._decryptor is None or self._buffer or self._remaining:
+            raise Exception('Encrypted content is truncated!')
@@ -0,0 +1,141 @@
+"""Reed-Solomon erasure coding over GF(2^8).
+
+Data shards are stored as is and parity shards are computed with a Cauchy
+matrix, so any data_shards out of data_shards + parity_shards shards rebuild
+all the others. Multiplying a whole shard by a constant is a single translate
+call and shards are summed with the XOR parity engine.
+"""
+from parity import xor_bytes
+
+# x^8 + x^4 + x^3 + x^2 + 1
+PRIMITIVE_POLYNOMIAL = 0x11d
+
+# Data and parity shards of a stripe need distinct field elements
+MAX_SHARDS = 256
+
+EXP = [0] * 512
+LOG = [0] * 256
+
+_value = 1
+for _power in xrange(255):
+    EXP[_power] = _value
+    LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= PRIMITIVE_POLYNOMIAL
+for _power in xrange(255, 512):
+    EXP[_power] = EXP[_power - 255]
+
+
+def gf_mul(a, b):
+    """Multiplies two field elements."""
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    """Returns the multiplicative inverse of a field element."""
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(2^8)')
+    return EXP[255 - LOG[a]]
+
+
+# Translation table multiplying every byte of a buffer by a constant
+MUL_TABLES = [bytes(bytearray(gf_mul(constant, value) for value in xrange(256)))
+              for constant in xrange(256)]
+
+
+def mul_bytes(constant, data):
+    """Multiplies every byte of a buffer by a field element."""
+    if constant == 1:
+        return data
+    return data.translate(MUL_TABLES[constant])
+
+
+def coefficient(parity_index, data_index, data_shards):
+    """Cauchy matrix entry weighing a data shard into a parity shard."""
+    return gf_inv((data_shards + parity_index) ^ data_index)
+
+
+def _combine(coefficients, shards):
+    """Sums shards multiplied by their coefficients."""
+    result = None
+    for constant, shard in zip(coefficients, shards):
+        if not constant:
+            continue
+        term = mul_bytes(constant, shard)
+        result = term if result is None else xor_bytes(result, term)
+    return result
+
+
+def encode_row(parity_index, shards):
+    """Computes a single parity shard out of equally sized data shards."""
+    data_shards = len(shards)
+    return _combine([coefficient(parity_index, data_index, data_shards)
+                     for data_index in xrange(data_shards)], shards)
+
+
+def encode(shards, parity_shards):
+    """Computes all parity shards out of equally sized data shards."""
+    return [encode_row(parity_index, shards) for parity_index in xrange(parity_shards)]
+
+
+def _generator_row(index, data_shards):
+    """Row of the generator matrix producing the shard at the given index."""
+    if index < data_shards:
+        return [1 if column == index else 0 for column in xrange(data_shards)]
+    return [coefficient(index - data_shards, column, data_shards)
+            for column in xrange(data_shards)]
+
+
+def _invert(matrix):
+    """Inverts a square matrix with Gauss-Jordan elimination."""
+    size = len(matrix)
+    rows = [list(row) + [1 if column == index else 0 for column in xrange(size)]
+            for index, row in enumerate(matrix)]
+
+    for column in xrange(size):
+        pivot = next((index for index in xrange(column, size) if rows[index][column]), None)
+        if pivot is None:
+            raise Exception('Shard matrix is singular, cannot decode!')
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        inverse = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(inverse, value) for value in rows[column]]
+        for index in xrange(size):
+            factor = rows[index][column]
+            if index != column and factor:
+                rows[index] = [value ^ gf_mul(factor, pivot_value)
+                               for value, pivot_value in zip(rows[index], rows[column])]
+
+    return [row[size:] for row in rows]
+
+
+def decode(available, data_shards):
+    """Rebuilds all data shards out of any data_shards available shards.
+
+    available maps shard indexes (data shards first, then parity shards) to
+    equally sized shards.
+    """
+    if len(available) < data_shards:
+        raise Exception('Data loss detected! Only {} of {} required shards available.'
+                        .format(len(available), data_shards))
+    if all(index in available for index in xrange(data_shards)):
+        return [available[index] for index in xrange(data_shards)]
+
+    # prefer data shards, they have the simplest rows
+    indexes = sorted(available)[:data_shards]
+    inverse = _invert([_generator_row(index, data_shards) for index in indexes])
+    shards = [available[index] for index in indexes]
+    return [available[data_index] if data_index in available
+            else _combine(inverse[data_index], shards)
+            for data_index in xrange(data_shards)]
+
+
+def reconstruct_shard(available, data_shards, index):
+    """Rebuilds the shard at the given index out of any data_shards available shards."""
+    data = decode(available, data_shards)
+    if index < data_shards:
+        return data[index]
+    return encode_row(index - data_shards, data)
@@ -1,17 +1,30 @@
-import os
+import hashlib
+import io
+from logging import debug
 
 from cloud_io import CloudFactory
 from encryption import AesCoder
 import constants
-from compression import zip_file, unzip_file
+import metrics
+import piece_cache
+import placement
+from compression import (DecompressingWriter, compress_bytes, decompress_bytes, zip_bytes,
+                         unzip_bytes)
 
 
 class FilePiece(object):
     """Represents a piece of a file"""
 
     def __init__(self, piece_name, parent_file, cloud=None,
-                 piece_type=constants.REGULAR, metadata=None):
-        """Constructor"""
+                 piece_type=constants.REGULAR, metadata=None, loader=None,
+                 codec=constants.DEFAULT_CODEC, size=None):
+        """Constructor
+
+        loader is a callable returning the plain content of the piece, it is
+        called only when the content is needed so pieces don't pile up in memory.
+        codec is the compression.CODECS name applied before encryption.
+        size is the expected size of the plain content, until it is known.
+        """
         self.name = piece_name
         self.encrypted_name = "{}.enc".format(self.name)
         self.zipped_name = '{}.zip'.format(self.encrypted_name)
@@ -20,18 +33,35 @@ class FilePiece(object):
         self.cloud = cloud
         self.piece_type = piece_type
         self.metadata = metadata
+        self.loader = loader
+        self.codec = codec
+
+        # plain content and its encrypted/compressed form as held in memory
+        self.data = None
+        self.payload = None
 
-        self._files_to_cleanup = set()
         self.cloud_alias = "blah"
         self.encryption = "AES"  # for applying a behavioral pattern
 
         self.siblings = []
+        self.size = size
+        # set once the bytes placement booked for the upload are released
+        self.released = False
+        # SHA-256 of the piece as uploaded, encrypted
+        self.checksum = None
+        # erasure coded pieces know their stripe: {"members": [...], "data_shards": k}
+        self.stripe = None
 
         if metadata:
             self.cloud = metadata["cloud"]
             self.piece_type = metadata["piece_type"]
             self.cloud_alias = metadata["cloud_alias"]
             self.siblings = metadata["siblings"]
+            self.size = metadata.get("size")
+            self.stripe = metadata.get("stripe")
+            self.checksum = metadata.get("checksum")
+            # pieces uploaded before codecs existed hold zipped ciphertext
+            self.codec = metadata.get("codec")
 
         self.available_locally = False
 
@@ -53,52 +83,162 @@ class FilePiece(object):
                 return False
             raise
 
-    def encrypt(self, encryption_key):
-        """Encrypts the file piece"""
-        print "Encrypting {} to {}...".format(self.name, self.encrypted_name)
-        AesCoder.encrypt_file(encryption_key, in_filename=self.name,
-                              out_filename=self.encrypted_name)
+    def read(self):
+        """Returns the plain content of the file piece"""
+        if self.data is not None:
+            return self.data
+        if self.loader:
+            return self.loader()
+        raise Exception("Content of {} is not available!".format(self.name))
+
+    def compress(self):
+        """Compresses the file piece with its codec"""
+        data = self.read()
+        self.size = len(data)
+        with metrics.span('compress', cloud=self.cloud, size=self.size):
+            self.codec, self.payload = compress_bytes(data, self.codec or constants.DEFAULT_CODEC)
+        self.data = None
         self.available_locally = False
 
+    def decompress(self):
+        """Uncompresses the decrypted file piece into its plain content"""
+        if self.codec is None:
+            self.data = self.payload
+        else:
+            with metrics.span('decompress', cloud=self.cloud, size=len(self.payload)):
+                self.data = decompress_bytes(self.payload, self.codec)
+        self.payload = None
+        self.available_locally = True
+
+    def encrypt(self, encryption_key):
+        """Encrypts the compressed file piece"""
+        debug("Encrypting {} to {}...".format(self.name, self.encrypted_name))
+        with metrics.span('encrypt', cloud=self.cloud, size=len(self.payload)):
+            self.payload = AesCoder.encrypt_bytes(encryption_key, self.payload)
+
     def decrypt(self, encryption_key):
         """Decrypts the file piece"""
-        print "Decrypting {} to {}...".format(self.encrypted_name, self.name)
-        AesCoder.decrypt_file(encryption_key, self.encrypted_name,
-                              out_filename=self.name)
-        self.available_locally = True
+        debug("Decrypting {} to {}...".format(self.encrypted_name, self.name))
+        with metrics.span('decrypt', cloud=self.cloud, size=len(self.payload)):
+            self.payload = AesCoder.decrypt_bytes(encryption_key, self.payload)
 
     def zip(self):
         """compresses the encrypted file piece"""
-        zip_file(src_file=self.encrypted_name, dst_file=self.zipped_name, cleanup=True)
+        self.payload = zip_bytes(self.payload, arcname=self.encrypted_name)
 
     def unzip(self):
         """uncompresses the downloaded piece into encrypted file piece"""
-        unzip_file(self.zipped_name)
+        self.payload = unzip_bytes(self.payload)
+
+    def encode(self, encryption_key):
+        """Compresses and encrypts the file piece ahead of its upload"""
+        self.compress()
+        self.encrypt(encryption_key)
+
+    def decode(self, encryption_key):
+        """Turns the downloaded file piece back into its plain content"""
+        if self.codec is None:
+            self.unzip()
+        self.decrypt(encryption_key)
+        self.decompress()
 
     def upload(self):
         """Uploads the file piece"""
-        file_id = self.cloud_connection.upload(self.zipped_name, self.zipped_name)
+        self.checksum = hashlib.sha256(self.payload).hexdigest()
+        try:
+            with metrics.span('upload', cloud=self.cloud, size=len(self.payload)):
+                file_id = self.cloud_connection.upload_stream(self.encrypted_name,
+                                                              io.BytesIO(self.payload))
+        finally:
+            self.release()
         self.metadata = {
             "cloud": self.cloud,
             "piece_type": self.piece_type,
             "file_id": file_id,
             "cloud_alias": self.cloud_alias,
-            "siblings": self.siblings
+            "siblings": self.siblings,
+            "size": self.size,
+            "codec": self.codec,
+            "stripe": self.stripe,
+            "checksum": self.checksum
         }
-        self._files_to_cleanup.add(self.zipped_name)
+        self.payload = None
+
+    def release(self):
+        """Releases the plain size placement booked on the cloud of the piece, once."""
+        if not self.released:
+            self.released = True
+            placement.scheduler.release(self.cloud, self.size)
 
     def download(self):
         """Downloads the file piece"""
         if not self.metadata or not self.metadata["file_id"]:
             raise Exception("Required metadata not found!")
 
-        with open(self.zipped_name, "wb") as zipped_file:
+        cache = piece_cache.cache
+        if cache:
+            self.payload = cache.get(self.cloud, self.metadata["file_id"], self.checksum)
+            if self.payload is not None:
+                return
+
+        downloaded_file = io.BytesIO()
+        with metrics.span('download', cloud=self.cloud) as span:
             self.cloud_connection.download(file_id=self.metadata["file_id"],
-                                           local_file_handle=zipped_file)
-
-    def __del__(self):
-        """Cleans up local files"""
-        for file_piece in self._files_to_cleanup:
-            if os.path.exists(file_piece):
-                print("Removing {}...".format(file_piece))
-                os.remove(file_piece)
+                                           local_file_handle=downloaded_file)
+            self.payload = downloaded_file.getvalue()
+            span['size'] = len(self.payload)
+        if self.checksum and hashlib.sha256(self.payload).hexdigest() != self.checksum:
+            self.payload = None
+            raise Exception("Checksum mismatch, {} is corrupt!".format(self.name))
+        if cache:
+            cache.put(self.cloud, self.metadata["file_id"], self.payload)
+
+    @property
+    def is_cached(self):
+        """Checks if the file piece can be read from the local piece cache"""
+        cache = piece_cache.cache
+        return bool(cache and self.metadata and
+                    cache.contains(self.cloud, self.metadata["file_id"], self.checksum))
+
+    def restore(self, encryption_key, sink):
+        """Downloads the file piece, decoding it into a writable sink as it streams in.
+
+        Only the chunk being downloaded is held in memory, whatever the piece size.
+        """
+        if not self.metadata or not self.metadata["file_id"]:
+            raise Exception("Required metadata not found!")
+
+        if self.codec is None:
+            # legacy pieces are zipped as a whole, they can only be decoded in memory
+            self.download()
+            self.decode(encryption_key)
+            sink.write(self.read())
+            self.data = None
+            return
+
+        plain = DecompressingWriter(self.codec, sink)
+        cipher = AesCoder.decryptor(encryption_key, plain)
+        file_id = self.metadata["file_id"]
+        cache = piece_cache.cache
+        if cache and cache.read_into(self.cloud, file_id, cipher, self.checksum):
+            cipher.close()
+            plain.close()
+            return
+
+        # the download is verified, and cached, as it streams through
+        target = piece_cache.ChecksumWriter(cipher, self.checksum)
+        if cache:
+            target = cache.writer(self.cloud, file_id, target)
+        try:
+            with metrics.span('download', cloud=self.cloud) as span:
+                self.cloud_connection.download(file_id=file_id, local_file_handle=target)
+                span['size'] = cipher.received
+            target.close()
+            cipher.close()
+            plain.close()
+        except Exception:
+            if cache:
+                target.discard()
+            raise
+        if cache:
+            target.commit()
@@ -0,0 +1,172 @@
+import os
+import uuid
+from functools import partial
+from logging import info
+
+import constants
+import placement
+import recovery_manager
+from file_models.file_piece import FilePiece
+from file_models.sprinkle_file import SprinkleFile, pad_key, upload_stages
+from pipeline import PiecePipeline
+
+
+def read_pack(members):
+    """Reads the content of a pack of small files given as (filename, length) pairs"""
+    contents = []
+    for filename, length in members:
+        with open(filename, 'rb') as member_file:
+            content = member_file.read()
+        if len(content) != length:
+            raise Exception("{} changed while being packed!".format(filename))
+        contents.append(content)
+    return b''.join(contents)
+
+
+class SprinkleBatch(object):
+    """Uploads many files through one shared pipeline
+
+    Pieces of different files are encoded and uploaded side by side. Metadata
+    is recorded in the metadata store every checkpoint_files files, with a
+    single commit, so an interrupted batch only redoes its last checkpoint.
+
+    Files smaller than pack_threshold bytes are packed together into pieces of
+    up to pack_size bytes, the record of a packed file holds the pack piece
+    with its recovery group and the slice of the pack that is the file.
+    """
+
+    def __init__(self, filenames, encryption_key=constants.DEFAULT_ENCRYPTION_KEY,
+                 metadata_store=None, recovery_algorithm=None, pipeline=None,
+                 codec=constants.DEFAULT_CODEC, chunk_index=None,
+                 checkpoint_files=constants.BATCH_CHECKPOINT_FILES, skip_unchanged=True,
+                 pack_threshold=constants.PACK_FILE_THRESHOLD, pack_size=constants.PACK_SIZE):
+        """Constructor
+
+        With skip_unchanged, files whose size and modification time match their
+        record in metadata_store are not uploaded again. A pack_threshold of 0
+        turns packing off.
+        """
+        self.filenames = list(filenames)
+        self.encryption_key = encryption_key
+        self.metadata_store = metadata_store
+        self.recovery_algorithm = recovery_algorithm
+        self.pipeline = pipeline if pipeline else PiecePipeline()
+        self.codec = codec
+        self.chunk_index = chunk_index
+        self.checkpoint_files = checkpoint_files
+        self.skip_unchanged = skip_unchanged
+        self.pack_threshold = pack_threshold
+        self.pack_size = pack_size
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """Creates a batch of every file under a directory"""
+        filenames = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            filenames.extend(os.path.join(root, name) for name in sorted(files))
+        return cls(filenames, **kwargs)
+
+    def _is_unchanged(self, filename):
+        if not (self.skip_unchanged and self.metadata_store is not None):
+            return False
+        record = self.metadata_store.get(filename)
+        if not record:
+            return False
+        stat = os.stat(filename)
+        return record.get("size") == stat.st_size and record.get("mtime") == stat.st_mtime
+
+    def upload(self):
+        """Sprinkles every file of the batch, returns their metadata by file name"""
+        filenames = [filename for filename in self.filenames
+                     if not self._is_unchanged(filename)]
+        info('Uploading {} of {} files...'.format(len(filenames), len(self.filenames)))
+
+        uploaded = {}
+        for start in xrange(0, len(filenames), self.checkpoint_files):
+            checkpoint = filenames[start:start + self.checkpoint_files]
+            uploaded.update(self._upload_checkpoint(checkpoint))
+        return uploaded
+
+    def _pack(self, filenames):
+        """Groups small files into packs, returns the packs and the other files"""
+        packs = []
+        large = []
+        pack = []
+        pack_length = 0
+        for filename in filenames:
+            size = os.path.getsize(filename)
+            if size >= self.pack_threshold:
+                large.append(filename)
+                continue
+            if pack and pack_length + size > self.pack_size:
+                packs.append(pack)
+                pack = []
+                pack_length = 0
+            pack.append((filename, size))
+            pack_length += size
+        if pack:
+            packs.append(pack)
+        return packs, large
+
+    def _upload_checkpoint(self, filenames):
+        packs, filenames = self._pack(filenames)
+        sprinkle_files = [SprinkleFile(filename, encryption_key=self.encryption_key,
+                                       recovery_algorithm=self.recovery_algorithm,
+                                       pipeline=self.pipeline, codec=self.codec,
+                                       chunk_index=self.chunk_index)
+                          for filename in filenames]
+        file_pieces = [sprinkle_file.prepare_upload() for sprinkle_file in sprinkle_files]
+
+        pack_pieces = []
+        for pack in packs:
+            pack_name = 'pack_{}'.format(uuid.uuid4().hex)
+            pack_length = sum(length for _, length in pack)
+            pack_pieces.append(FilePiece(pack_name, pack_name,
+                                         placement.scheduler.choose(pack_length),
+                                         loader=partial(read_pack, pack), codec=self.codec,
+                                         size=pack_length))
+        if pack_pieces:
+            recovery_algorithm = (self.recovery_algorithm or
+                                  recovery_manager.xor_raid4_file_recovery)
+            pack_pieces = recovery_algorithm(pack_pieces)
+
+        all_pieces = [piece for pieces in file_pieces for piece in pieces] + pack_pieces
+        try:
+            self.pipeline.run(all_pieces, upload_stages(pad_key(self.encryption_key)))
+        finally:
+            # pieces the pipeline failed before uploading still hold their booking
+            for piece in all_pieces:
+                piece.release()
+
+        uploaded = {}
+        for sprinkle_file, pieces in zip(sprinkle_files, file_pieces):
+            sprinkle_file.finish_upload(pieces)
+            uploaded[sprinkle_file.filename] = sprinkle_file.metadata
+        uploaded.update(self._pack_records(packs, pack_pieces))
+
+        if self.metadata_store is not None:
+            for filename, metadata in uploaded.items():
+                self.metadata_store.put(filename, metadata, commit=False)
+            self.metadata_store.commit()
+        return uploaded
+
+    def _pack_records(self, packs, pack_pieces):
+        """Returns the metadata of every packed file"""
+        pieces_meta = dict((piece.name, piece.metadata) for piece in pack_pieces)
+        records = {}
+        for pack, pack_piece in zip(packs, pack_pieces):
+            group = recovery_manager.recovery_group(pack_piece.name, pieces_meta)
+            offset = 0
+            for filename, length in pack:
+                stat = os.stat(filename)
+                records[filename] = {
+                    "pieces": group,
+                    "merge_order": [pack_piece.name],
+                    "pack": {"offset": offset, "length": length},
+                    "zipped": False,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime
+                }
+                offset += length
+        return records
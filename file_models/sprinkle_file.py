@@ -1,79 +1,271 @@
+import hashlib
+import hmac
 import os
-import pprint
-import random
+from functools import partial
+from logging import debug
+
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import constants
 from cloud_io import CloudFactory
-from compression import zip_file, unzip_file
-from constants import REGULAR
+from compression import unzip_file
+from constants import CLOUD_STAGE, CPU_STAGE
 from file_models.file_piece import FilePiece
+from file_models.sprinkle_reader import SprinkleReader
+from pipeline import PiecePipeline
+import metrics
+import placement
 import recovery_manager
+import repair_queue
+
+
+def pad_key(encryption_key):
+    """Pads an encryption key to the 32 bytes of AES-256."""
+    return "{:$^32}".format(encryption_key)
+
+
+def upload_stages(encryption_key):
+    """Pipeline stages pieces go through to be uploaded."""
+    return [
+        (CPU_STAGE, lambda piece: piece.encode(encryption_key)),
+        (CLOUD_STAGE, lambda piece: piece.upload())
+    ]
 
 
 class SprinkleFile(object):
     """Models the target file to be uploaded/downloaded"""
     def __init__(self, filename, encryption_key=constants.DEFAULT_ENCRYPTION_KEY,
-                 metadata=None, recovery_algorithm=None):
+                 metadata=None, recovery_algorithm=None, pipeline=None,
+                 codec=constants.DEFAULT_CODEC, chunk_index=None, hedged_reads=True):
+        """Constructor
+
+        With a chunk_index (see cloud_io.ChunkIndex) the file is split into content
+        defined chunks and chunks found in the index are not uploaded again. With
+        hedged_reads, pieces slow to download are rebuilt from their siblings meanwhile.
+        """
         self.filename = filename
         self.zipped_filename = "{}.zip".format(filename)
-        self.encryption_key = "{:$^32}".format(encryption_key)
+        self.encryption_key = pad_key(encryption_key)
         self.metadata = {"pieces": {}, "merge_order": []} if not metadata else metadata
+        self.codec = codec
+        self.chunk_index = chunk_index
+        self.hedged_reads = hedged_reads
+        # pieces found missing by the last download
+        self._lost = set()
+        # chunk digests by piece name, from prepare_upload to finish_upload
+        self._digests = {}
 
         if recovery_algorithm:
             self.recovery_algorithm = recovery_algorithm
         else:
             self.recovery_algorithm = recovery_manager.xor_raid4_file_recovery
 
-        self.file_pieces = []
+        self.pipeline = pipeline if pipeline else PiecePipeline()
 
     def upload(self):
         """Sprinkles a given file onto the clouds."""
-        zip_file(self.filename, self.zipped_filename)
-        merge_order = recovery_manager.split_file(filename=self.zipped_filename)
-        self.metadata["merge_order"] = merge_order
+        file_pieces = self.prepare_upload()
+        try:
+            self.pipeline.run(file_pieces, upload_stages(self.encryption_key))
+        finally:
+            # pieces the pipeline failed before uploading still hold their booking
+            for piece in file_pieces:
+                piece.release()
+        self.finish_upload(file_pieces)
+
+    def prepare_upload(self):
+        """Splits the file and sets up recovery, returns the pieces to upload."""
+        stat = os.stat(self.filename)
+        self.metadata["size"] = stat.st_size
+        self.metadata["mtime"] = stat.st_mtime
+        with metrics.span('split', size=stat.st_size):
+            if self.chunk_index is None:
+                chunks = [(piece_name, offset, length, None) for piece_name, offset, length
+                          in recovery_manager.split_stream(filename=self.filename)]
+            else:
+                chunks = list(recovery_manager.split_content(self.filename, self._chunk_digest))
+        # every piece is compressed on its own, the file itself is not zipped
+        self.metadata["zipped"] = False
 
-        all_clouds = CloudFactory.get_cloud_names()
-        file_pieces = [
-            FilePiece(
+        # pieces are read from the source file only when they are compressed
+        file_pieces = []
+        digests = {}
+        merge_order = []
+        for piece_name, offset, length, digest in chunks:
+            entry = self.chunk_index.get(digest) if self.chunk_index is not None else None
+            if entry:
+                # the piece of another file may hold the chunk, under its own name
+                piece_name = entry["piece"]
+            merge_order.append(piece_name)
+            if piece_name in digests:
+                continue  # repeated within the file
+            digests[piece_name] = digest
+
+            if entry:
+                # uploaded before, reference the existing piece and its siblings
+                self.metadata["pieces"].update(entry["pieces"])
+                continue
+
+            file_pieces.append(FilePiece(
                 piece_name,
                 self.filename,
-                random.choice(all_clouds)
-            ) for piece_name in merge_order
-        ]
+                placement.scheduler.choose(length),
+                loader=partial(recovery_manager.read_chunk, self.filename, offset, length),
+                codec=self.codec,
+                size=length
+            ))
+
+        self.metadata["merge_order"] = merge_order
+        self._digests = digests
 
         # setup recovery
-        file_pieces = self.recovery_algorithm(file_pieces)
+        return self.recovery_algorithm(file_pieces)
 
+    def finish_upload(self, file_pieces):
+        """Records the uploaded pieces in the metadata."""
+        # pieces finish in any order, record them in a deterministic one
         for piece in file_pieces:
-            piece.encrypt(self.encryption_key)
-            piece.zip()
-            piece.upload()
             self.metadata["pieces"][piece.name] = piece.metadata
 
+        if self.chunk_index is not None:
+            self._index_chunks(self._digests)
+
+    def _chunk_digest(self, chunk):
+        """Keyed digest of a chunk, pieces can only be shared under the same key."""
+        return hmac.new(self.encryption_key, chunk, hashlib.sha256).hexdigest()
+
+    def _index_chunks(self, digests):
+        """Records the pieces of the file in the chunk index."""
+        for piece_name in self.metadata["merge_order"]:
+            entry = self.chunk_index.get(digests[piece_name])
+            if entry is None:
+                # keep the whole recovery group so any of its pieces can be rebuilt
+                pieces = recovery_manager.recovery_group(piece_name, self.metadata["pieces"])
+                entry = {"piece": piece_name, "pieces": pieces, "refs": 0}
+                self.chunk_index[digests[piece_name]] = entry
+            entry["refs"] += 1
+
+    def plan_download(self):
+        """Classifies all pieces as present or missing, checking each cloud once.
+
+        With hedged_reads, pieces on clouds too slow to answer are taken as
+        present, their downloads fall back on their siblings if they are not.
+        """
+        names_by_cloud = {}
+        for name, piece_meta in self.metadata["pieces"].iteritems():
+            names_by_cloud.setdefault(piece_meta["cloud"], []).append(name)
+
+        def check(cloud):
+            file_ids = [self.metadata["pieces"][name]["file_id"] for name in names_by_cloud[cloud]]
+            return CloudFactory.get_cloud(cloud).exists_many(file_ids)
+
+        pool = ThreadPoolExecutor(max(1, len(names_by_cloud)))
+        try:
+            checks = dict((pool.submit(check, cloud), cloud) for cloud in names_by_cloud)
+            timeout = None
+            if self.hedged_reads and names_by_cloud:
+                timeout = max(placement.scheduler.hedge_delay(cloud, 1) for cloud in names_by_cloud)
+            done, _ = wait(checks, timeout=timeout)
+        finally:
+            pool.shutdown(wait=False)
+
+        present = []
+        missing = []
+        for future, cloud in checks.iteritems():
+            if future not in done:
+                debug("{} is slow to answer, assuming its pieces are there".format(cloud))
+                present.extend(names_by_cloud[cloud])
+                continue
+            exists = future.result()
+            for name in names_by_cloud[cloud]:
+                file_id = self.metadata["pieces"][name]["file_id"]
+                (present if exists.get(file_id) else missing).append(name)
+        return sorted(present), sorted(missing)
+
     def download(self):
         """Gets the sprinkled file from the clouds."""
-        for name, file_meta in self.metadata["pieces"].iteritems():
-            piece = FilePiece(name, self.filename, metadata=file_meta)
-            if not piece.exists_in_cloud:
-                pprint.pprint(self.metadata["pieces"][name])
-                metadata = recovery_manager.reconstruct(piece, self.metadata, self.encryption_key)
-                self.metadata["pieces"][name] = metadata
-                pprint.pprint(self.metadata["pieces"][name])
-
-            if piece.piece_type == REGULAR:
-                piece.download()
-                piece.unzip()
-                piece.decrypt(self.encryption_key)
-
-            self.file_pieces.append(piece)
-
-        recovery_manager.merge_files(self.metadata["merge_order"],
-                                     destination_filename=self.zipped_filename)
-        unzip_file(src_file=self.zipped_filename)
-
-    def __del__(self):
-        """Cleans up local files"""
-        for file_piece in self.file_pieces:
-            if os.path.exists(file_piece.name):
-                print("Removing {}...".format(file_piece.name))
-                os.remove(file_piece.name)
+        _, missing = self.plan_download()
+        self._lost = set(missing)
+        needed = set(self.best_copy(name).name for name in self.metadata["merge_order"])
+        for name in missing:
+            if name not in needed and repair_queue.queue is not None:
+                # not read, the repair queue rebuilds it on its own
+                repair_queue.queue.submit(self.filename, self.metadata, name, self.encryption_key,
+                                          on_repaired=self._repaired)
+
+        if "pack" in self.metadata:
+            # packed along with other small files, only its slice of the pack is needed
+            with self.open() as reader, open(self.filename, 'wb') as target_file:
+                target_file.write(reader.read(0, reader.size))
+            return
+
+        offsets = recovery_manager.piece_offsets(self.metadata["merge_order"],
+                                                 self.metadata["pieces"])
+        pieces = []
+        for name in list(offsets):
+            piece = self.best_copy(name)
+            offsets[piece.name] = offsets[name]
+            pieces.append(piece)
+
+        # files uploaded before pieces had codecs were zipped as a whole
+        zipped = self.metadata.get("zipped", True)
+        target_filename = self.zipped_filename if zipped else self.filename
+
+        # pieces arrive in any order and stream straight to their offsets
+        open(target_filename, 'wb').close()
+        self.pipeline.run(pieces, [
+            (CLOUD_STAGE, lambda piece: self._restore_piece(piece, target_filename,
+                                                            offsets[piece.name]))
+        ])
+        if zipped:
+            unzip_file(src_file=self.zipped_filename)
+
+    def best_copy(self, name):
+        """Returns the piece, or a duplicate of it, expected to download the fastest."""
+        pieces_meta = self.metadata["pieces"]
+        copies = [name] + [sibling for sibling in pieces_meta[name]["siblings"]
+                           if pieces_meta[sibling]["piece_type"] == constants.DUP]
+        copies = [copy for copy in copies if copy not in self._lost] or [name]
+        clouds = dict((pieces_meta[copy]["cloud"], copy) for copy in reversed(copies))
+        copy = clouds[placement.scheduler.fastest(list(clouds),
+                                                  pieces_meta[name].get("size"))]
+        return FilePiece(copy, self.filename, metadata=pieces_meta[copy])
+
+    def open(self, cache_pieces=constants.READER_CACHE_PIECES):
+        """Returns a SprinkleReader reading byte ranges of the file from the clouds."""
+        return SprinkleReader(self, cache_pieces=cache_pieces)
+
+    def restore_piece(self, piece, sink):
+        """Downloads and decodes a piece into a seekable sink, hedging slow downloads."""
+        if piece.name in self._lost:
+            # rebuilt in memory for the read, unless cached, uploaded again in the background
+            data = None
+            if piece.is_cached:
+                piece.restore(self.encryption_key, sink)
+            else:
+                data = recovery_manager.rebuild(piece, self.metadata, self.encryption_key)
+                sink.write(data)
+            if repair_queue.queue is not None:
+                repair_queue.queue.submit(self.filename, self.metadata, piece.name,
+                                          self.encryption_key, data=data,
+                                          on_repaired=self._repaired)
+            return
+        if not self.hedged_reads:
+            piece.restore(self.encryption_key, sink)
+            return
+        delay = placement.scheduler.hedge_delay(piece.cloud, piece.size)
+        recovery_manager.hedged_restore(piece, self.metadata, self.encryption_key, sink, delay)
+
+    def _repaired(self, piece_name, lost_file_id, piece_meta):
+        """Records the new copy of a piece repaired by the repair queue."""
+        repair_queue.repoint(self.metadata["pieces"], piece_name, lost_file_id, piece_meta)
+        if self.chunk_index is not None:
+            repair_queue.repoint_index(self.chunk_index, piece_name, lost_file_id, piece_meta)
+
+    def _restore_piece(self, piece, target_filename, offsets):
+        """Downloads and decodes a piece into its place in the target file."""
+        sink = recovery_manager.OffsetWriter(target_filename, offsets)
+        try:
+            self.restore_piece(piece, sink)
+        finally:
+            sink.close()
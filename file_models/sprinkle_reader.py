@@ -0,0 +1,104 @@
+import bisect
+import io
+import threading
+from collections import OrderedDict
+
+import constants
+from constants import CLOUD_STAGE
+
+
+class SprinkleReader(object):
+    """Reads byte ranges of a sprinkled file without restoring all of it
+
+    Only the pieces overlapping a range are downloaded and decoded, the most
+    recently used ones are kept in memory for the reads that follow.
+    """
+
+    def __init__(self, sprinkle_file, cache_pieces=constants.READER_CACHE_PIECES):
+        if sprinkle_file.metadata.get("zipped", True):
+            raise Exception("{} was zipped as a whole, it can only be downloaded entirely!"
+                            .format(sprinkle_file.filename))
+        self.sprinkle_file = sprinkle_file
+        self.cache_pieces = cache_pieces
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # start offset and name of every extent of the file, in order
+        pieces_meta = sprinkle_file.metadata["pieces"]
+        self._starts = []
+        self._names = []
+        self.size = 0
+        for piece_name in sprinkle_file.metadata["merge_order"]:
+            self._starts.append(self.size)
+            self._names.append(piece_name)
+            self.size += pieces_meta[piece_name].get("size") or constants.CHUNK_SIZE
+
+        # a small file packed with others is a slice of its pack
+        self._base = 0
+        pack = sprinkle_file.metadata.get("pack")
+        if pack:
+            self._base = pack["offset"]
+            self.size = pack["length"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def read(self, offset, length):
+        """Returns length bytes of the file from offset, fewer past its end"""
+        if offset < 0 or length < 0:
+            raise Exception("Invalid range {}+{}!".format(offset, length))
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+        offset += self._base
+        end += self._base
+
+        first = bisect.bisect_right(self._starts, offset) - 1
+        last = bisect.bisect_left(self._starts, end) - 1
+        extents = range(first, last + 1)
+        contents = self._fetch([self._names[index] for index in extents])
+
+        parts = []
+        for index in extents:
+            content = contents[self._names[index]]
+            start = self._starts[index]
+            parts.append(content[max(offset - start, 0):end - start])
+        return b''.join(parts)
+
+    def _fetch(self, names):
+        """Returns the plain content of the named pieces, downloading uncached ones"""
+        contents = {}
+        with self._cache_lock:
+            for name in names:
+                if name in self._cache:
+                    contents[name] = self._cache.pop(name)
+                    self._cache[name] = contents[name]
+
+        missing = sorted(set(names) - set(contents))
+        if missing:
+            pieces = [self.sprinkle_file.best_copy(name) for name in missing]
+            results = self.sprinkle_file.pipeline.run(pieces, [
+                (CLOUD_STAGE, self._download)
+            ])
+            for name, content in zip(missing, results):
+                contents[name] = content
+                self._remember(name, content)
+        return contents
+
+    def _download(self, piece):
+        sink = io.BytesIO()
+        self.sprinkle_file.restore_piece(piece, sink)
+        return sink.getvalue()
+
+    def _remember(self, name, content):
+        with self._cache_lock:
+            self._cache[name] = content
+            while len(self._cache) > self.cache_pieces:
+                self._cache.popitem(last=False)
@@ -0,0 +1,250 @@
+"""Metadata of sprinkled files kept as per file records.
+
+Every change is appended to a journal in the clouds as a small segment,
+holding only the records that changed. Segments are periodically compacted
+into a snapshot of all records. A local SQLite database keeps the records
+along with the segments already applied, so a sync only downloads what other
+writers added since the last one.
+
+    store = MetadataStore()
+    store.sync()
+    store.put(filename, sprinkle_file.metadata)
+    metadata = store.get(filename)
+"""
+import io
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from logging import debug, info, warning
+
+from cloud_io import CloudFactory, Metadata
+from constants import METADATA_COMPACT_SEGMENTS, METADATA_DB
+from encryption import AesCoder
+
+SEGMENT_PREFIX = 'metadata.journal.'
+SNAPSHOT_PREFIX = 'metadata.snapshot.'
+
+# Journal operations
+PUT = 'put'
+DELETE = 'delete'
+
+
+class MetadataStore(object):
+    """Per file metadata records, journaled onto the clouds."""
+
+    ENCRYPTION_KEY = Metadata.ENCRYPTION_KEY
+
+    def __init__(self, db_filename=METADATA_DB, compact_segments=METADATA_COMPACT_SEGMENTS):
+        self.compact_segments = compact_segments
+        self.writer_id = uuid.uuid4().hex[:8]
+        self._lock = threading.RLock()
+        self._pending = []
+        self._db = sqlite3.connect(db_filename, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS records '
+                             '(name TEXT PRIMARY KEY, record BLOB NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS segments (name TEXT PRIMARY KEY)')
+
+    def close(self):
+        self._db.close()
+
+    # records
+
+    def get(self, name, default=None):
+        """Returns the metadata record of a file."""
+        with self._lock:
+            row = self._db.execute('SELECT record FROM records WHERE name = ?',
+                                   (name,)).fetchone()
+        return pickle.loads(bytes(row[0])) if row else default
+
+    def __getitem__(self, name):
+        record = self.get(name)
+        if record is None:
+            raise KeyError(name)
+        return record
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM records WHERE name = ?',
+                                    (name,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def names(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT name FROM records ORDER BY name')]
+
+    def put(self, name, record, commit=True):
+        """Sets the metadata record of a file, journaled right away unless commit is False."""
+        with self._lock:
+            self._pending.append((PUT, name, record))
+            self._apply([(PUT, name, record)])
+        if commit:
+            self.commit()
+
+    def delete(self, name, commit=True):
+        """Drops the metadata record of a file."""
+        with self._lock:
+            self._pending.append((DELETE, name, None))
+            self._apply([(DELETE, name, None)])
+        if commit:
+            self.commit()
+
+    def _apply(self, operations, segment_name=None):
+        with self._db:
+            for operation, name, record in operations:
+                if operation == PUT:
+                    self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                                     (name, sqlite3.Binary(pickle.dumps(record, -1))))
+                else:
+                    self._db.execute('DELETE FROM records WHERE name = ?', (name,))
+            if segment_name:
+                self._db.execute('INSERT OR IGNORE INTO segments VALUES (?)', (segment_name,))
+
+    def _applied_segments(self):
+        return set(row[0] for row in self._db.execute('SELECT name FROM segments'))
+
+    # journal
+
+    def _encode(self, content):
+        return AesCoder.encrypt_bytes(self.ENCRYPTION_KEY,
+                                      zlib.compress(pickle.dumps(content, -1), 6))
+
+    def _decode(self, payload):
+        return pickle.loads(zlib.decompress(AesCoder.decrypt_bytes(self.ENCRYPTION_KEY, payload)))
+
+    def _remote(self, prefix):
+        """Maps the names of the journal files in the clouds to a cloud holding each."""
+        files = {}
+        for cloud_conn in CloudFactory.get_cloud_connections():
+            for entry in cloud_conn.find_prefixed(prefix):
+                files.setdefault(entry['name'], (cloud_conn, entry['id']))
+        return files
+
+    def _download(self, location):
+        cloud_conn, file_id = location
+        downloaded_file = io.BytesIO()
+        cloud_conn.download(file_id, downloaded_file)
+        return self._decode(downloaded_file.getvalue())
+
+    def _upload(self, name, content):
+        """Uploads a journal file onto every cloud, failing only if no cloud got it."""
+        payload = self._encode(content)
+        uploaded = 0
+        error = None
+        for cloud_conn in CloudFactory.get_cloud_connections():
+            try:
+                cloud_conn.upload_stream(name, io.BytesIO(payload))
+                uploaded += 1
+            except Exception as exc:
+                warning('Could not upload {} to {}: {!r}'.format(name, cloud_conn.name, exc))
+                error = exc
+        if not uploaded and error is not None:
+            raise error
+
+    def _segment_name(self, prefix):
+        # names sort in time order, the writer id tells concurrent writers apart
+        return '{}{:017.6f}.{}.enc'.format(prefix, time.time(), self.writer_id)
+
+    def commit(self):
+        """Appends the pending changes to the journal as one segment."""
+        with self._lock:
+            if not self._pending:
+                return
+            operations = list(self._pending)
+            name = self._segment_name(SEGMENT_PREFIX)
+            # the changes stay pending until a cloud holds them
+            self._upload(name, operations)
+            self._pending = []
+            with self._db:
+                self._db.execute('INSERT OR IGNORE INTO segments VALUES (?)', (name,))
+            debug('Committed {} metadata change(s) in {}'.format(len(operations), name))
+
+        if len(self._remote(SEGMENT_PREFIX)) > self.compact_segments:
+            self.compact()
+
+    def sync(self, refresh=False):
+        """Applies the journal segments other writers added since the last sync.
+
+        With refresh the clouds are listed again instead of trusting cached listings.
+        """
+        if refresh:
+            for cloud_conn in CloudFactory.get_cloud_connections():
+                cloud_conn.invalidate_listing()
+
+        with self._lock:
+            applied = self._applied_segments()
+            snapshots = self._remote(SNAPSHOT_PREFIX)
+            segments = self._remote(SEGMENT_PREFIX)
+
+            if not applied and not snapshots and not segments and not len(self):
+                self._import_legacy()
+                return
+
+            # a snapshot newer than what was applied replaces every record
+            latest = max(snapshots) if snapshots else None
+            if latest and latest not in applied:
+                snapshot = self._download(snapshots[latest])
+                with self._db:
+                    self._db.execute('DELETE FROM records')
+                    self._db.execute('DELETE FROM segments')
+                    self._db.executemany('INSERT INTO segments VALUES (?)',
+                                         [(name,) for name in snapshot['segments'] + [latest]])
+                self._apply([(PUT, name, record)
+                             for name, record in snapshot['records'].items()])
+                applied = self._applied_segments()
+
+            new_segments = sorted(name for name in segments if name not in applied)
+            for name in new_segments:
+                self._apply(self._download(segments[name]), segment_name=name)
+            # local changes not yet journaled win over older remote ones
+            self._apply(self._pending)
+            debug('Applied {} metadata segment(s)'.format(len(new_segments)))
+
+    def compact(self):
+        """Folds the journal into a snapshot of every record and drops what it covers."""
+        # cached listings could hide segments and snapshots of other writers
+        self.sync(refresh=True)
+        with self._lock:
+            records = dict((name, self.get(name)) for name in self.names())
+            # the segments and earlier snapshots folded into the records, only
+            # those still in the clouds need to be told apart from newer ones
+            remote = set(self._remote(SEGMENT_PREFIX)) | set(self._remote(SNAPSHOT_PREFIX))
+            included = self._applied_segments() & remote
+            name = self._segment_name(SNAPSHOT_PREFIX)
+            self._upload(name, {'records': records, 'segments': sorted(included)})
+            info('Compacted {} metadata records into {}'.format(len(records), name))
+
+            # what a concurrent writer added meanwhile is not in the snapshot, keep it
+            kept = set()
+            for cloud_conn in CloudFactory.get_cloud_connections():
+                for prefix in (SEGMENT_PREFIX, SNAPSHOT_PREFIX):
+                    for entry in cloud_conn.find_prefixed(prefix):
+                        if entry['name'] not in included:
+                            continue
+                        try:
+                            cloud_conn.delete(entry['id'])
+                        except Exception as exc:
+                            warning('Could not delete {} from {}: {!r}'.format(
+                                entry['name'], cloud_conn.name, exc))
+                            kept.add(entry['name'])
+
+            # names of deleted journal files are not needed anymore
+            with self._db:
+                self._db.execute('DELETE FROM segments')
+                self._db.executemany('INSERT INTO segments VALUES (?)',
+                                     [(segment,) for segment in kept | set([name])])
+
+    def _import_legacy(self):
+        """Turns the single pickle of earlier versions into the first snapshot."""
+        legacy = Metadata.load()
+        if not legacy:
+            return
+        info('Importing the metadata of {} files'.format(len(legacy)))
+        self._apply([(PUT, name, record) for name, record in legacy.items()])
+        self.compact()
@@ -0,0 +1,188 @@
+"""Counters, histograms and spans around the stages of the sprinkle pipeline.
+
+Stages report through the module level registry, e.g.
+
+    with metrics.span('upload', cloud='dropbox', size=len(payload)):
+        ...
+
+which times the stage into sprinkle_stage_seconds and counts its bytes into
+sprinkle_stage_bytes_total, both labelled with the stage and the cloud.
+Listeners added with add_listener get every finished span, for tracing.
+Swap the registry with set_registry to plug in another backend.
+"""
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets for stage durations
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = 'sprinkle_stage_seconds'
+STAGE_BYTES = 'sprinkle_stage_bytes_total'
+STAGE_ERRORS = 'sprinkle_stage_errors_total'
+
+
+class Counter(object):
+    """A monotonically increasing value."""
+
+    kind = 'counter'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """Counts observations into cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = []
+            total = 0
+            for count in self.bucket_counts:
+                total += count
+                cumulative.append(total)
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            return OrderedDict([('count', self.count), ('sum', self.sum),
+                                ('buckets', OrderedDict(zip(bounds, cumulative)))])
+
+
+class MetricsRegistry(object):
+    """Holds every metric by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()
+        self._listeners = []
+
+    def _get(self, metric_class, name, labels):
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items()
+                                  if value is not None)))
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = metric_class()
+            return self._metrics[key]
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    def add_listener(self, listener):
+        """Calls listener with a dict describing every finished span."""
+        self._listeners.append(listener)
+
+    @contextmanager
+    def span(self, stage, cloud=None, size=None):
+        """Times a pipeline stage and counts the bytes it handled.
+
+        Yields the span record, set its size when it is only known at the end.
+        """
+        record = {'stage': stage, 'cloud': cloud, 'size': size, 'start': time.time(),
+                  'seconds': None, 'error': None}
+        try:
+            yield record
+        except Exception as exc:
+            record['error'] = repr(exc)
+            self.counter(STAGE_ERRORS, stage=stage, cloud=cloud).inc()
+            raise
+        finally:
+            record['seconds'] = time.time() - record['start']
+            self.histogram(STAGE_SECONDS, stage=stage, cloud=cloud).observe(record['seconds'])
+            if record['size']:
+                self.counter(STAGE_BYTES, stage=stage, cloud=cloud).inc(record['size'])
+            for listener in self._listeners:
+                listener(record)
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def snapshot(self):
+        """Returns every metric as a list of plain dicts."""
+        with self._lock:
+            items = list(self._metrics.items())
+        return [OrderedDict([('name', name), ('type', metric.kind),
+                             ('labels', OrderedDict(labels)), ('value', metric.snapshot())])
+                for (name, labels), metric in items]
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        declared = set()
+        for metric in self.snapshot():
+            name = metric['name']
+            if name not in declared:
+                lines.append('# TYPE {} {}'.format(name, metric['type']))
+                declared.add(name)
+
+            labels = metric['labels']
+            if metric['type'] == 'counter':
+                lines.append('{}{} {}'.format(name, _labels(labels), metric['value']))
+                continue
+            for bound, count in metric['value']['buckets'].items():
+                bucket_labels = OrderedDict(labels)
+                bucket_labels['le'] = bound
+                lines.append('{}_bucket{} {}'.format(name, _labels(bucket_labels), count))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), metric['value']['sum']))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), metric['value']['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    """Formats labels as {name="value",...}."""
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(label, value.replace('"', '\\"'))
+                                    for label, value in labels.items()))
+
+
+registry = MetricsRegistry()
+
+
+def set_registry(new_registry):
+    """Plugs in another registry, returns the previous one."""
+    global registry
+    previous, registry = registry, new_registry
+    return previous
+
+
+def span(stage, cloud=None, size=None):
+    return registry.span(stage, cloud=cloud, size=size)
+
+
+def counter(name, **labels):
+    return registry.counter(name, **labels)
+
+
+def histogram(name, **labels):
+    return registry.histogram(name, **labels)
@@ -0,0 +1,71 @@
+"""XOR parity engine used for piece recovery."""
+import operator
+from array import array
+
+try:
+    # numpy, required by requirements.txt, XORs whole buffers as machine words, the pure
+    # Python fallback only keeps parity working where it could not be installed
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size of the blocks streamed through the parity engine in bytes
+XOR_BLOCK_SIZE = 256 * 1024
+
+# Machine words XORed at once by the fallback
+WORD = array('L')
+
+
+def _xor_numpy(buf1, buf2):
+    """XORs two buffers using numpy word operations."""
+    length = len(buf1)
+    dtype = numpy.uint64 if length % 8 == 0 else numpy.uint8
+    words1 = numpy.frombuffer(buf1, dtype=dtype)
+    words2 = numpy.frombuffer(buf2, dtype=dtype)
+    return numpy.bitwise_xor(words1, words2).tobytes()
+
+
+def _xor_words(buf1, buf2):
+    """XORs two buffers machine word by machine word, without numpy."""
+    if hasattr(int, 'from_bytes'):
+        # python 3 XORs two arbitrarily wide integers in C
+        value = int.from_bytes(buf1, 'big') ^ int.from_bytes(buf2, 'big')
+        return value.to_bytes(len(buf1), 'big')
+    cut = len(buf1) - len(buf1) % WORD.itemsize
+    words = array(WORD.typecode, map(operator.xor, array(WORD.typecode, buf1[:cut]),
+                                     array(WORD.typecode, buf2[:cut])))
+    tail = bytearray(byte1 ^ byte2 for byte1, byte2
+                     in zip(bytearray(buf1[cut:]), bytearray(buf2[cut:])))
+    return words.tostring() + bytes(tail)
+
+
+def xor_bytes(buf1, buf2):
+    """XORs two equally sized buffers in one go."""
+    if len(buf1) != len(buf2):
+        raise Exception('Length of two buffers not same, we may lose data!')
+    if not buf1:
+        return b''
+    if numpy is not None:
+        return _xor_numpy(buf1, buf2)
+    return _xor_words(buf1, buf2)
+
+
+def xor_padded(buf1, buf2):
+    """XORs two buffers, padding the shorter one with zeros."""
+    length = max(len(buf1), len(buf2))
+    return xor_bytes(buf1.ljust(length, b'\0'), buf2.ljust(length, b'\0'))
+
+
+def xor_streams(stream1, stream2, destination, block_size=XOR_BLOCK_SIZE):
+    """XORs two readable streams block by block onto a destination stream."""
+    total = 0
+    while True:
+        block1 = stream1.read(block_size)
+        block2 = stream2.read(block_size)
+        if len(block1) != len(block2):
+            raise Exception('Length of two streams not same, we may lose data!')
+        if not block1:
+            break
+        destination.write(xor_bytes(block1, block2))
+        total += len(block1)
+    return total
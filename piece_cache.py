@@ -0,0 +1,259 @@
+"""On-disk cache of downloaded pieces, still encrypted as they are in the clouds.
+
+Pieces are looked up by cloud and file id and stored once per content, in a
+file named after the SHA-256 of the content which is checked on the first
+hit, and again whenever the file changed on disk since.
+The least recently used pieces are evicted once the cache outgrows its size.
+"""
+import hashlib
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+from constants import PIECE_CACHE_DIR, PIECE_CACHE_SIZE
+
+# Size of the blocks cached pieces are hashed and streamed in
+BLOCK_SIZE = 1024 * 1024
+
+
+def make_directory(directory):
+    """Creates a directory and its parents, unless it exists already."""
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+class PieceCache(object):
+    """Size bounded LRU of encrypted pieces."""
+
+    INDEX_FILENAME = 'index.pickle'
+
+    def __init__(self, directory=PIECE_CACHE_DIR, max_bytes=PIECE_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # content digest by (cloud, file id), least recently used first
+        self._entries = None
+        # size of every cached content by digest
+        self._sizes = {}
+        # size and modification time of the files whose content was verified
+        self._verified = {}
+
+    @property
+    def size(self):
+        with self._lock:
+            self._load()
+            return sum(self._sizes.values())
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def _stat(self, digest):
+        try:
+            stat = os.stat(self._path(digest))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        index_path = os.path.join(self.directory, self.INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as index_file:
+                self._entries, self._sizes = pickle.load(index_file)
+
+    def _store(self):
+        make_directory(self.directory)
+        temp_path = os.path.join(self.directory, '{}.tmp'.format(self.INDEX_FILENAME))
+        with open(temp_path, 'wb') as index_file:
+            pickle.dump((self._entries, self._sizes), index_file)
+        os.rename(temp_path, os.path.join(self.directory, self.INDEX_FILENAME))
+
+    def _drop(self, key):
+        """Forgets an entry, removes its content once nothing refers to it."""
+        digest = self._entries.pop(key, None)
+        if digest and digest not in self._entries.values():
+            self._sizes.pop(digest, None)
+            self._verified.pop(digest, None)
+            if os.path.exists(self._path(digest)):
+                os.remove(self._path(digest))
+
+    def _evict(self):
+        while self._entries and sum(self._sizes.values()) > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _hit(self, cloud, file_id, checksum):
+        """Returns the path of a verified cached piece, None on a miss."""
+        key = (cloud, file_id)
+        with self._lock:
+            self._load()
+            digest = self._entries.get(key)
+            if digest is None:
+                return None
+            if checksum and checksum != digest:
+                self._drop(key)
+                self._store()
+                return None
+            self._entries[key] = self._entries.pop(key)
+            stat = self._stat(digest)
+            if stat is not None and self._verified.get(digest) == stat:
+                return self._path(digest)
+
+        sha256 = hashlib.sha256()
+        try:
+            with open(self._path(digest), 'rb') as cached_file:
+                for block in iter(lambda: cached_file.read(BLOCK_SIZE), b''):
+                    sha256.update(block)
+        except IOError:
+            pass
+        if sha256.hexdigest() != digest:
+            # corrupt or vanished, the cloud has to be asked again
+            with self._lock:
+                self._drop(key)
+                self._store()
+            return None
+        with self._lock:
+            self._verified[digest] = stat
+        return self._path(digest)
+
+    def contains(self, cloud, file_id, checksum=None):
+        """Checks if a verified copy of a piece is cached."""
+        return self._hit(cloud, file_id, checksum) is not None
+
+    def get(self, cloud, file_id, checksum=None):
+        """Returns the cached content of a piece, None on a miss.
+
+        A checksum, the SHA-256 of the piece as uploaded, rejects stale entries.
+        """
+        path = self._hit(cloud, file_id, checksum)
+        if path is None:
+            return None
+        with open(path, 'rb') as cached_file:
+            return cached_file.read()
+
+    def read_into(self, cloud, file_id, handle, checksum=None, chunk_size=BLOCK_SIZE):
+        """Streams a cached piece into a writable handle, returns False on a miss."""
+        path = self._hit(cloud, file_id, checksum)
+        if path is None:
+            return False
+        with open(path, 'rb') as cached_file:
+            for block in iter(lambda: cached_file.read(chunk_size), b''):
+                handle.write(block)
+        return True
+
+    def put(self, cloud, file_id, data):
+        """Caches the content of a piece."""
+        writer = self.writer(cloud, file_id)
+        writer.write(data)
+        writer.commit()
+
+    def writer(self, cloud, file_id, downstream=None):
+        """Returns a sink caching what is written to it, passed on to downstream.
+
+        Nothing is cached until its commit, after the whole piece was written.
+        """
+        return CacheWriter(self, cloud, file_id, downstream)
+
+    def _add(self, cloud, file_id, temp_path, digest, size):
+        with self._lock:
+            self._load()
+            self._drop((cloud, file_id))
+            if size > self.max_bytes:
+                os.remove(temp_path)
+                return
+            if digest in self._sizes:
+                os.remove(temp_path)
+            else:
+                os.rename(temp_path, self._path(digest))
+                self._sizes[digest] = size
+                # hashed as it was written
+                self._verified[digest] = self._stat(digest)
+            self._entries[(cloud, file_id)] = digest
+            self._evict()
+            self._store()
+
+    def invalidate(self, cloud, file_id):
+        """Drops a piece from the cache."""
+        with self._lock:
+            self._load()
+            if (cloud, file_id) in self._entries:
+                self._drop((cloud, file_id))
+                self._store()
+
+    def clear(self):
+        with self._lock:
+            self._load()
+            for key in list(self._entries):
+                self._drop(key)
+            self._store()
+
+
+class CacheWriter(object):
+    """Writes a piece to a temporary file of the cache while hashing it."""
+
+    def __init__(self, cache, cloud, file_id, downstream=None):
+        self.cache = cache
+        self.cloud = cloud
+        self.file_id = file_id
+        self.downstream = downstream
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        make_directory(cache.directory)
+        self._temp_path = os.path.join(cache.directory, '{}.part'.format(uuid.uuid4().hex))
+        self._file = open(self._temp_path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        if self.downstream is not None:
+            self.downstream.write(data)
+
+    def close(self):
+        if self.downstream is not None and hasattr(self.downstream, 'close'):
+            self.downstream.close()
+
+    def commit(self):
+        """Adds the written piece to the cache."""
+        self._file.close()
+        self.cache._add(self.cloud, self.file_id, self._temp_path,
+                        self._sha256.hexdigest(), self.size)
+
+    def discard(self):
+        """Throws away what was written, after a failed download."""
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+class ChecksumWriter(object):
+    """Passes what is written on to downstream, checking its SHA-256 on close."""
+
+    def __init__(self, downstream, checksum=None):
+        self.downstream = downstream
+        self.checksum = checksum
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._sha256.update(data)
+        self.downstream.write(data)
+
+    def close(self):
+        if self.checksum and self._sha256.hexdigest() != self.checksum:
+            raise Exception('Checksum mismatch, the piece is corrupt!')
+
+
+cache = PieceCache()
+
+
+def set_cache(new_cache):
+    """Plugs in another cache, None disables caching. Returns the previous one."""
+    global cache
+    previous, cache = cache, new_cache
+    return previous
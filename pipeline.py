@@ -0,0 +1,91 @@
+"""Concurrent pipeline that moves file pieces through the clouds."""
+import multiprocessing
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from constants import CPU_STAGE, DEFAULT_CLOUD_CONCURRENCY, MAX_PIECES_IN_FLIGHT
+
+
+class PiecePipeline(object):
+    """Runs the stages of many file pieces concurrently.
+
+    CPU stages (encryption, compression) of all pieces share one worker pool
+    while every cloud gets its own pool for network transfers, sized by its
+    concurrency limit. At most max_in_flight pieces are worked on at once.
+    """
+
+    def __init__(self, cpu_workers=None, cloud_concurrency=None,
+                 max_in_flight=MAX_PIECES_IN_FLIGHT):
+        self.cpu_workers = cpu_workers or multiprocessing.cpu_count()
+        self.cloud_concurrency = cloud_concurrency or {}
+        self.max_in_flight = max_in_flight
+
+    def concurrency_for(self, cloud):
+        """Returns the number of concurrent transfers allowed for a cloud."""
+        return self.cloud_concurrency.get(cloud, DEFAULT_CLOUD_CONCURRENCY)
+
+    def run(self, pieces, stages):
+        """Runs every piece through the given stages.
+
+        stages is a list of (kind, func) tuples where kind is either CPU_STAGE
+        or CLOUD_STAGE and func takes the piece. Returns the result of the last
+        stage for every piece, in the order the pieces were given.
+        """
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        failed = threading.Event()
+        errors = []
+
+        cpu_pool = ThreadPoolExecutor(self.cpu_workers)
+        cloud_pools = {}
+        for piece in pieces:
+            if piece.cloud not in cloud_pools:
+                cloud_pools[piece.cloud] = ThreadPoolExecutor(self.concurrency_for(piece.cloud))
+
+        def submit(piece, index):
+            kind = stages[index][0]
+            pool = cpu_pool if kind == CPU_STAGE else cloud_pools[piece.cloud]
+            return pool.submit(run_stage, piece, index)
+
+        def run_stage(piece, index):
+            if failed.is_set():
+                # an earlier piece failed, don't waste any more work
+                in_flight.release()
+                return None
+            try:
+                result = stages[index][1](piece)
+            except Exception as exc:
+                errors.append(exc)
+                failed.set()
+                in_flight.release()
+                raise
+            if index + 1 == len(stages):
+                in_flight.release()
+                return result
+            return submit(piece, index + 1)
+
+        futures = []
+        results = []
+        try:
+            for piece in pieces:
+                in_flight.acquire()
+                if failed.is_set():
+                    in_flight.release()
+                    break
+                futures.append(submit(piece, 0))
+
+            for future in futures:
+                try:
+                    result = future.result()
+                    while isinstance(result, Future):
+                        result = result.result()
+                except Exception:
+                    result = None
+                results.append(result)
+        finally:
+            cpu_pool.shutdown()
+            for pool in cloud_pools.values():
+                pool.shutdown()
+
+        if errors:
+            raise errors[0]
+        return results
@@ -0,0 +1,171 @@
+"""Places pieces on the clouds expected to store or serve them the fastest.
+
+The scheduler learns the latency, throughput and error rate of every cloud
+from the upload and download spans reported through metrics, and asks the
+clouds for their free space. A piece goes to the cloud where it is expected
+to be done first, counting the bytes already assigned to every cloud, so
+faster clouds get more pieces while slower ones still share the load. Clouds
+whose circuit breaker is open get no pieces until it closes again.
+"""
+import random
+import threading
+import time
+
+import metrics
+from cloud_io import CloudFactory
+from constants import CHUNK_SIZE, HEDGE_LATENCY_FACTOR, HEDGE_MIN_DELAY, QUOTA_TTL
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# Weight of a new observation in the moving averages
+ALPHA = 0.2
+
+# Assumed for clouds not observed yet, in seconds and bytes per second
+PRIOR_LATENCY = 0.1
+PRIOR_THROUGHPUT = 1024 * 1024
+
+# Transfers smaller than this only tell the latency of a cloud
+MIN_THROUGHPUT_SAMPLE = 64 * 1024
+
+# Error rate above which a cloud is only used when no other one is left
+MAX_ERROR_RATE = 0.5
+
+
+def circuit_open(cloud):
+    """Tells if calls to a cloud are currently cut off by its circuit breaker."""
+    policy = getattr(CloudFactory.get_cloud(cloud), 'policy', None)
+    return policy is not None and policy.breaker.is_open
+
+
+class CloudStats(object):
+    """Moving averages of the transfers of a cloud in one direction."""
+
+    def __init__(self):
+        self.latency = PRIOR_LATENCY
+        self.throughput = PRIOR_THROUGHPUT
+        self.error_rate = 0.0
+        self.samples = 0
+
+    def observe(self, size, seconds, failed):
+        self.samples += 1
+        self.error_rate += ALPHA * ((1.0 if failed else 0.0) - self.error_rate)
+        if failed:
+            return
+        if not size or size < MIN_THROUGHPUT_SAMPLE:
+            self.latency += ALPHA * (seconds - self.latency)
+        else:
+            transfer_seconds = max(seconds - self.latency, 1e-6)
+            self.throughput += ALPHA * (size / transfer_seconds - self.throughput)
+
+    def estimate(self, size):
+        """Seconds a transfer of size bytes is expected to take, retries included."""
+        seconds = self.latency + size / float(self.throughput)
+        return seconds / max(1.0 - self.error_rate, 0.05)
+
+
+class PlacementScheduler(object):
+    """Chooses clouds for uploads and copies for downloads."""
+
+    def __init__(self, registry=None):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._assigned = {}
+        self._free_space = {}
+        (registry or metrics.registry).add_listener(self.observe)
+
+    def stats(self, cloud, direction=UPLOAD):
+        with self._lock:
+            return self._stats_for(cloud, direction)
+
+    def _stats_for(self, cloud, direction):
+        if (cloud, direction) not in self._stats:
+            self._stats[(cloud, direction)] = CloudStats()
+        return self._stats[(cloud, direction)]
+
+    def observe(self, span):
+        """Learns from a finished metrics span."""
+        if span['stage'] not in (UPLOAD, DOWNLOAD) or not span['cloud']:
+            return
+        with self._lock:
+            self._stats_for(span['cloud'], span['stage']).observe(
+                span['size'], span['seconds'], span['error'] is not None)
+
+    def book(self, cloud, size=None):
+        """Counts size bytes as assigned to a cloud until they are released."""
+        with self._lock:
+            self._assigned[cloud] = self._assigned.get(cloud, 0) + (size or CHUNK_SIZE)
+
+    def release(self, cloud, size=None):
+        """Releases bytes booked on a cloud once their upload is over, failed or not."""
+        with self._lock:
+            self._assigned[cloud] = max(0, self._assigned.get(cloud, 0) - (size or CHUNK_SIZE))
+
+    def free_space(self, cloud):
+        """Bytes still free on a cloud, None when it can't tell."""
+        with self._lock:
+            checked_at, free = self._free_space.get(cloud, (None, None))
+        if checked_at is None or time.time() - checked_at > QUOTA_TTL:
+            try:
+                free = CloudFactory.get_cloud(cloud).free_space()
+            except Exception:
+                free = None
+            with self._lock:
+                self._free_space[cloud] = (time.time(), free)
+        return free
+
+    def choose(self, size=None, exclude=(), previous=None):
+        """Returns the cloud a piece of size bytes is expected to be uploaded to first.
+
+        exclude holds clouds the piece must not go to, such as the clouds of
+        its siblings. previous is a cloud the piece was assigned to before.
+        The size is booked on the cloud until the upload of the piece releases it.
+        """
+        size = size or CHUNK_SIZE
+        clouds = [cloud for cloud in CloudFactory.get_cloud_names() if cloud not in exclude]
+        if not clouds:
+            raise Exception('No cloud left to place the piece on!')
+
+        roomy = []
+        for cloud in clouds:
+            free = self.free_space(cloud)
+            if free is None or free - self._assigned.get(cloud, 0) >= size:
+                roomy.append(cloud)
+        if not roomy:
+            raise Exception('No cloud has {} bytes of free space left!'.format(size))
+
+        reachable = [cloud for cloud in roomy if not circuit_open(cloud)]
+        with self._lock:
+            healthy = [cloud for cloud in reachable
+                       if self._stats_for(cloud, UPLOAD).error_rate <= MAX_ERROR_RATE]
+            candidates = healthy or reachable or roomy
+            # ties go to a random cloud so equal clouds share the load
+            random.shuffle(candidates)
+            best = min(candidates, key=lambda cloud: self._stats_for(cloud, UPLOAD).estimate(
+                self._assigned.get(cloud, 0) + size))
+            if previous is not None:
+                self._assigned[previous] = max(0, self._assigned.get(previous, 0) - size)
+            self._assigned[best] = self._assigned.get(best, 0) + size
+        return best
+
+    def fastest(self, clouds, size=None):
+        """Returns the cloud among clouds expected to serve a download first."""
+        size = size or CHUNK_SIZE
+        clouds = [cloud for cloud in clouds if not circuit_open(cloud)] or clouds
+        with self._lock:
+            return min(clouds, key=lambda cloud: self._stats_for(cloud, DOWNLOAD).estimate(size))
+
+    def hedge_delay(self, cloud, size=None):
+        """Seconds after which a download from a cloud is slower than it should be."""
+        expected = self.stats(cloud, DOWNLOAD).estimate(size or CHUNK_SIZE)
+        return max(HEDGE_MIN_DELAY, HEDGE_LATENCY_FACTOR * expected)
+
+
+scheduler = PlacementScheduler()
+
+
+def set_scheduler(new_scheduler):
+    """Plugs in another scheduler, returns the previous one."""
+    global scheduler
+    previous, scheduler = scheduler, new_scheduler
+    return previous
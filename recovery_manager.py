@@ -1,11 +1,34 @@
+import hashlib
 import os
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from chunking import iter_chunks
+from logging import debug, info
 
 from cloud_io import CloudFactory
-from constants import XOR, DUP
+from constants import CHUNK_SIZE, DUP, PARITY, XOR
+import erasure_coding
+import metrics
+import placement
 from file_models.file_piece import FilePiece
+from parity import xor_padded, xor_streams
+
+
+def piece_prefix(filename):
+    """Returns the prefix of the piece names of a file, also their names in the clouds.
 
-# Size of split files in bytes
-CHUNK_SIZE = 1024 * 1024
+    Cloud names can't hold the separators of a path, a path is named after its
+    base name and a digest of the whole path, which only the metadata keeps.
+    """
+    base_name = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    if base_name == filename:
+        return filename
+    path = filename.encode('utf-8') if isinstance(filename, unicode) else filename
+    return base_name + '.' + hashlib.sha1(path).hexdigest()[:12]
 
 
 def split_file(filename, prefix=None, cleanup=True):
@@ -26,9 +49,41 @@ def split_file(filename, prefix=None, cleanup=True):
     return ['{}_{}'.format(prefix, i) for i in xrange(1, file_number)]
 
 
+def split_stream(filename, prefix=None):
+    """Yields the name, offset and length of every piece of a given file.
+
+    Nothing is written to disk, read_chunk loads the content of a piece on demand.
+    """
+    if not prefix:
+        prefix = piece_prefix(filename)
+    file_size = os.path.getsize(filename)
+    for file_number, offset in enumerate(xrange(0, file_size, CHUNK_SIZE), 1):
+        yield '{}_{}'.format(prefix, file_number), offset, min(CHUNK_SIZE, file_size - offset)
+
+
+def split_content(filename, digest_func, prefix=None):
+    """Yields the name, offset, length and digest of every content defined chunk.
+
+    Pieces are named after their digest, so identical chunks get identical names.
+    """
+    if not prefix:
+        prefix = piece_prefix(filename)
+    with open(filename, 'rb') as src_file:
+        for offset, chunk in iter_chunks(src_file):
+            digest = digest_func(chunk)
+            yield '{}_{}'.format(prefix, digest[:16]), offset, len(chunk), digest
+
+
+def read_chunk(filename, offset, length):
+    """Reads a single chunk of a given file."""
+    with open(filename, 'rb') as src_file:
+        src_file.seek(offset)
+        return src_file.read(length)
+
+
 def merge_files(piece_names, destination_filename, cleanup=True):
     """Merges the given file pieces into one."""
-    with open(destination_filename, 'wb') as dest_file:
+    with open(destination_filename, 'wb') as dest_file, metrics.span('merge'):
         for piece in piece_names:
             with open(piece, 'rb') as chunk_file:
                 chunk = chunk_file.read()
@@ -37,22 +92,57 @@ def merge_files(piece_names, destination_filename, cleanup=True):
                     os.remove(piece)
 
 
+def piece_offsets(merge_order, pieces_meta):
+    """Maps every piece in the merge order to its offsets in the merged file."""
+    offsets = OrderedDict()
+    position = 0
+    for piece_name in merge_order:
+        offsets.setdefault(piece_name, []).append(position)
+        # metadata of older uploads lacks sizes, all but the last piece are full chunks
+        position += pieces_meta[piece_name].get("size") or CHUNK_SIZE
+    return offsets
+
+
+class OffsetWriter(object):
+    """File-like sink writing a chunk as it streams in at all its offsets."""
+
+    def __init__(self, destination_filename, offsets):
+        self.destination_filename = destination_filename
+        self.offsets = offsets
+        self.position = 0
+        self._file = open(destination_filename, 'r+b')
+
+    def write(self, data):
+        if not data:
+            return
+        with metrics.span('merge', size=len(data) * len(self.offsets)):
+            for offset in self.offsets:
+                self._file.seek(offset + self.position)
+                self._file.write(data)
+        self.position += len(data)
+
+    def seek(self, position):
+        self.position = position
+
+    def close(self):
+        self._file.close()
+
+
 def xor_files(file1, file2, destination_file_handle, cleanup=False):
     """XORs the given two files onto a destination file handle."""
-    file1_bytes = bytearray(open(file1, 'rb').read())
-    file2_bytes = bytearray(open(file2, 'rb').read())
+    file1_size = os.path.getsize(file1)
+    file2_size = os.path.getsize(file2)
 
-    if len(file1_bytes) != len(file2_bytes):
-        print(len(file1_bytes), len(file2_bytes))
+    if file1_size != file2_size:
+        debug('Sizes: {}, {}'.format(file1_size, file2_size))
         raise Exception('Length of two files not same, we may lose data!')
 
-    print 'XORing {} and {} of length {} into {}...'.format(
-        file1, file2, len(file1_bytes), destination_file_handle.name)
-    result = bytearray()
-    for i in xrange(len(file1_bytes)):
-        result.append(file1_bytes[i] ^ file2_bytes[i])
+    debug('XORing {} and {} of length {} into {}...'.format(
+        file1, file2, file1_size, destination_file_handle.name))
+    with open(file1, 'rb') as file1_handle, open(file2, 'rb') as file2_handle, \
+            metrics.span('xor', size=file1_size):
+        xor_streams(file1_handle, file2_handle, destination_file_handle)
 
-    destination_file_handle.write(result)
     if cleanup:
         os.remove(file1)
         os.remove(file2)
@@ -60,25 +150,29 @@ def xor_files(file1, file2, destination_file_handle, cleanup=False):
 
 def xor_raid4_file_recovery(file_pieces):
     """XOR based RAID4 file recovery algorithm."""
-    all_clouds = CloudFactory.get_cloud_names()
+    scheduler = placement.scheduler
     xor_pieces = []
     dup_pieces = []
 
     def create_dup_file(file_piece):
         """Creates duplicate file for recovery."""
-        orig_file_name = file_piece.name
         dup_file_name = '{}.dup'.format(file_piece.name)
-        with open(orig_file_name, 'rb') as orig, open(dup_file_name, 'wb') as dup:
-            dup.write(orig.read())
-
-        target_cloud = next(cloud for cloud in all_clouds if cloud != file_piece.cloud)
+        target_cloud = scheduler.choose(file_piece.size, exclude=[file_piece.cloud])
         dup_piece = FilePiece(dup_file_name, file_pieces[-1].parent_file,
-                              target_cloud, piece_type=DUP)
+                              target_cloud, piece_type=DUP, loader=file_piece.read,
+                              size=file_piece.size)
 
         file_piece.siblings = [dup_piece.name]
         dup_piece.siblings = [file_piece.name]
         return dup_piece
 
+    def xor_content(piece1, piece2):
+        """XORs the content of two pieces."""
+        content1 = piece1.read()
+        content2 = piece2.read()
+        with metrics.span('xor', size=max(len(content1), len(content2))):
+            return xor_padded(content1, content2)
+
     file_count = len(file_pieces)
     if file_count and file_count % 2 == 0:
         # It is very likely the last two pieces are not of the same size.
@@ -96,14 +190,18 @@ def xor_raid4_file_recovery(file_pieces):
 
     for i in xrange(0, file_count, 2):
         xor_file_name = '{}.xor'.format(file_pieces[i].name)
-        with open(xor_file_name, 'wb') as xor_file:
-            xor_files(file_pieces[i].name, file_pieces[i + 1].name, xor_file)
-
+        if file_pieces[i + 1].cloud == file_pieces[i].cloud:
+            # a pair sharing a cloud would be lost together
+            file_pieces[i + 1].cloud = scheduler.choose(file_pieces[i + 1].size,
+                                                        exclude=[file_pieces[i].cloud],
+                                                        previous=file_pieces[i + 1].cloud)
         clouds_taken = (file_pieces[i].cloud, file_pieces[i+1].cloud)
-        target_cloud = next(cloud for cloud in all_clouds
-                            if all(cloud != taken for taken in clouds_taken))
+        target_cloud = scheduler.choose(max(file_pieces[i].size, file_pieces[i + 1].size),
+                                        exclude=clouds_taken)
         xor_piece = FilePiece(xor_file_name, file_pieces[i].parent_file,
-                              target_cloud, piece_type=XOR)
+                              target_cloud, piece_type=XOR,
+                              loader=partial(xor_content, file_pieces[i], file_pieces[i + 1]),
+                              size=max(file_pieces[i].size, file_pieces[i + 1].size))
 
         xor_piece.siblings = [file_pieces[i].name, file_pieces[i + 1].name]
         file_pieces[i].siblings = [file_pieces[i + 1].name, xor_piece.name]
@@ -116,34 +214,204 @@ def xor_raid4_file_recovery(file_pieces):
     return file_pieces
 
 
-def reconstruct(file_piece, metadata, encryption_key):
-    """Reconstruct a lost piece with sibling pieces"""
-    print("Reconstructing {} from its sibling(s) {}..."
-          .format(file_piece.name, file_piece.siblings))
+def reed_solomon_file_recovery(data_shards=4, parity_shards=2):
+    """Returns a k-of-n erasure coding file recovery algorithm.
+
+    Pieces are grouped into stripes of data_shards pieces and every stripe gets
+    parity_shards parity pieces, any data_shards pieces of a stripe rebuild the
+    rest. Shards of a stripe are spread round robin over the clouds, so losing a
+    whole cloud is survived as long as no cloud holds more than parity_shards of them.
+    """
+    if data_shards < 1 or parity_shards < 1 or \
+            data_shards + parity_shards > erasure_coding.MAX_SHARDS:
+        raise Exception('Invalid shard configuration: {} data and {} parity shards.'
+                        .format(data_shards, parity_shards))
+
+    def parity_content(members, parity_index):
+        """Computes a parity shard of the given stripe members."""
+        shards = [member.read() for member in members]
+        length = max(len(shard) for shard in shards)
+        with metrics.span('erasure', size=length * len(shards)):
+            return erasure_coding.encode_row(parity_index,
+                                             [shard.ljust(length, b'\0') for shard in shards])
+
+    def recovery(file_pieces):
+        """Reed-Solomon erasure coding file recovery algorithm."""
+        cloud_count = len(CloudFactory.get_cloud_names())
+        parity_pieces = []
+
+        for start in xrange(0, len(file_pieces), data_shards):
+            members = file_pieces[start:start + data_shards]
+            shard_size = max(member.size for member in members)
+            parities = [
+                FilePiece('{}.parity{}'.format(members[0].name, parity_index),
+                          members[0].parent_file, piece_type=PARITY,
+                          loader=partial(parity_content, members, parity_index),
+                          size=shard_size)
+                for parity_index in xrange(parity_shards)
+            ]
+
+            stripe = members + parities
+            names = [piece.name for piece in stripe]
+            # no cloud holds more shards of the stripe than an even spread would
+            per_cloud = -(-len(stripe) // cloud_count)
+            held = {}
+            for piece in stripe:
+                full = [cloud for cloud, count in held.items() if count >= per_cloud]
+                piece.cloud = placement.scheduler.choose(piece.size, exclude=full,
+                                                         previous=piece.cloud)
+                held[piece.cloud] = held.get(piece.cloud, 0) + 1
+                piece.siblings = [name for name in names if name != piece.name]
+                piece.stripe = {"members": names, "data_shards": len(members)}
+            parity_pieces.extend(parities)
+
+        file_pieces.extend(parity_pieces)
+        return file_pieces
+
+    return recovery
+
+
+def recovery_group(piece_name, pieces_meta):
+    """Returns the metadata of a piece and of every piece needed to rebuild it."""
+    group = {}
+    pending = [piece_name]
+    while pending:
+        name = pending.pop()
+        if name not in group:
+            group[name] = pieces_meta[name]
+            pending.extend(group[name]["siblings"])
+    return group
+
+
+def _fetch_sibling(sibling_name, file_piece, metadata, encryption_key):
+    """Downloads and decodes a sibling piece, returns None if it is lost too."""
+    sibling_meta = metadata['pieces'][sibling_name]
+    sibling = FilePiece(sibling_name, file_piece.parent_file, metadata=sibling_meta)
+    if not sibling.is_cached and not sibling.exists_in_cloud:
+        return None
+    sibling.download()
+    sibling.decode(encryption_key)
+    return sibling.read()
+
+
+def _rebuild_from_siblings(file_piece, metadata, encryption_key):
+    """Rebuilds a piece from its XOR or DUP siblings."""
     siblings = []
     for sibling_name in file_piece.siblings:
-        sibling_meta = metadata['pieces'][sibling_name]
-        sibling = FilePiece(sibling_name, file_piece.parent_file, metadata=sibling_meta)
-        if not sibling.exists_in_cloud:
+        sibling = _fetch_sibling(sibling_name, file_piece, metadata, encryption_key)
+        if sibling is None:
             raise Exception('Data loss detected! Sibling could not be found on cloud.')
-        sibling.download()
-        sibling.unzip()
-        sibling.decrypt(encryption_key)
         siblings.append(sibling)
 
     if len(siblings) == 2:
-        with open(file_piece.name, 'wb') as xor_file:
-            xor_files(siblings[0].name, siblings[1].name, xor_file)
-
+        # content defined pieces differ in size, the XOR covers the longer one
+        return xor_padded(siblings[0], siblings[1])
     elif len(siblings) == 1:
-        with open(file_piece.name, 'wb') as missing_file:
-            with open(siblings[0].name, 'rb') as dup_file:
-                missing_file.write(dup_file.read())
-    else:
-        raise Exception("Invalid sibling configuration found! Siblings: {}."
-                        .format(file_piece.siblings))
-
-    file_piece.encrypt(encryption_key=encryption_key)
-    file_piece.zip()
-    file_piece.upload()
-    return file_piece.metadata
+        return siblings[0]
+    raise Exception("Invalid sibling configuration found! Siblings: {}."
+                    .format(file_piece.siblings))
+
+
+def _rebuild_from_stripe(file_piece, metadata, encryption_key):
+    """Rebuilds an erasure coded piece from the other members of its stripe."""
+    members = file_piece.stripe["members"]
+    data_shards = file_piece.stripe["data_shards"]
+
+    available = {}
+    for index, member_name in enumerate(members):
+        if len(available) == data_shards:
+            break
+        if member_name == file_piece.name:
+            continue
+        shard = _fetch_sibling(member_name, file_piece, metadata, encryption_key)
+        if shard is not None:
+            available[index] = shard
+
+    # shards were padded to the longest one of the stripe before encoding
+    length = max(len(shard) for shard in available.values()) if available else 0
+    available = dict((index, shard.ljust(length, b'\0'))
+                     for index, shard in available.iteritems())
+    return erasure_coding.reconstruct_shard(available, data_shards,
+                                            members.index(file_piece.name))
+
+
+def rebuild(file_piece, metadata, encryption_key):
+    """Rebuilds the plain content of a lost piece from its siblings."""
+    with metrics.span('rebuild', cloud=file_piece.cloud) as span:
+        if file_piece.stripe:
+            data = _rebuild_from_stripe(file_piece, metadata, encryption_key)
+        else:
+            data = _rebuild_from_siblings(file_piece, metadata, encryption_key)
+        span['size'] = len(data)
+
+    if file_piece.size is not None:
+        data = data[:file_piece.size]
+    return data
+
+
+class HedgeLost(Exception):
+    """Stops a download whose piece was rebuilt from its siblings first."""
+
+
+class _HedgedWriter(object):
+    """Passes the download of a piece on to its sink until the rebuild wins."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.written = 0
+        self.rebuilt = False
+
+    def write(self, data):
+        with self.lock:
+            if self.rebuilt:
+                raise HedgeLost()
+            self.sink.write(data)
+            self.written += len(data)
+
+    def write_rebuilt(self, data):
+        with self.lock:
+            self.rebuilt = True
+            if self.written:
+                # start over where the download started writing
+                self.sink.seek(0)
+            self.sink.write(data)
+
+
+def hedged_restore(file_piece, metadata, encryption_key, sink, delay):
+    """Restores a piece into sink, rebuilding it meanwhile if its download is slow.
+
+    Once the download took delay seconds, or failed, the piece is rebuilt from
+    its siblings on the other clouds in parallel. Whichever is done first goes
+    to sink, a rebuilt piece overwrites whatever the download wrote before, so
+    sink must be seekable.
+    """
+    if not file_piece.siblings:
+        file_piece.restore(encryption_key, sink)
+        return
+
+    writer = _HedgedWriter(sink)
+    pool = ThreadPoolExecutor(2)
+    try:
+        download = pool.submit(file_piece.restore, encryption_key, writer)
+        done, _ = wait([download], timeout=delay)
+        if download in done and download.exception() is None:
+            return
+
+        info("Download of {} is slow, rebuilding it from its sibling(s) {}..."
+             .format(file_piece.name, file_piece.siblings))
+        metrics.counter('sprinkle_hedged_reads_total', cloud=file_piece.cloud).inc()
+        hedge = pool.submit(rebuild, file_piece, metadata, encryption_key)
+        pending = set([download, hedge])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if download in done and download.exception() is None:
+                return
+            if hedge in done and hedge.exception() is None:
+                writer.write_rebuilt(hedge.result())
+                return
+        # the download failing tells more than its rebuild failing
+        raise download.exception()
+    finally:
+        # a download that lost keeps running until its next write
+        pool.shutdown(wait=False)
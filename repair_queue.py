@@ -0,0 +1,313 @@
+"""Background repair of lost pieces.
+
+Restores rebuild lost pieces in memory and leave their upload to the repair
+queue, so a read never waits on writes to a cloud that may be failing. Jobs
+run on the queue's own workers and are retried with backoff. They are
+persisted, along with the encrypted piece once it is known, so repairs
+survive restarts. Repaired pieces are recorded in the metadata store and the
+chunk index, and handed to the callback of the repair, if any. Without a
+store or a callback a repair is not queued, its new copy would be orphaned.
+
+    repair_queue.set_queue(repair_queue.RepairQueue(metadata_store=store, chunk_index=index))
+    repair_queue.queue.resume(encryption_key)
+    SprinkleFile(filename, metadata=store[filename]).download()
+    repair_queue.queue.join()
+"""
+import os
+import pickle
+import threading
+import time
+import uuid
+from logging import info, warning
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import piece_cache
+import placement
+import recovery_manager
+from cloud_io import CloudFactory
+from constants import (REPAIR_ATTEMPTS, REPAIR_RETRY_DELAY, REPAIR_SPOOL_DIR, REPAIR_STATE_FILE,
+                       REPAIR_WORKERS)
+from file_models.file_piece import FilePiece
+
+REPAIRS = 'sprinkle_repairs_total'
+
+
+def repoint(pieces, piece_name, lost_file_id, piece_meta):
+    """Points pieces at the new copy of a repaired piece, True if they held the lost one."""
+    old_meta = pieces.get(piece_name)
+    if not old_meta or old_meta["file_id"] != lost_file_id:
+        return False
+    pieces[piece_name] = piece_meta
+    return True
+
+
+def repoint_index(chunk_index, piece_name, lost_file_id, piece_meta):
+    """Points the chunk index entries holding a repaired piece at its new copy."""
+    changed = False
+    for entry in chunk_index.itervalues():
+        changed = repoint(entry["pieces"], piece_name, lost_file_id, piece_meta) or changed
+    return changed
+
+
+class RepairQueue(object):
+    """Uploads lost pieces again, in the background."""
+
+    def __init__(self, state_filename=REPAIR_STATE_FILE, spool_directory=REPAIR_SPOOL_DIR,
+                 workers=REPAIR_WORKERS, metadata_store=None, chunk_index=None):
+        self.state_filename = state_filename
+        self.spool_directory = spool_directory
+        self.workers = workers
+        self.metadata_store = metadata_store
+        self.chunk_index = chunk_index
+        self._lock = threading.Condition()
+        self._pool = None
+        # jobs by id, persisted
+        self._jobs = None
+        # encryption keys and rebuilt plain content by job id, never persisted
+        self._keys = {}
+        self._data = {}
+        # callbacks by job id, never persisted
+        self._callbacks = {}
+        # ids of the jobs queued or running
+        self._active = set()
+
+    def pending(self):
+        """Returns the number of pieces waiting for their repair."""
+        with self._lock:
+            return len(self._load())
+
+    def _load(self):
+        if self._jobs is None:
+            self._jobs = {}
+            if self.state_filename and os.path.exists(self.state_filename):
+                with open(self.state_filename, 'rb') as state_file:
+                    self._jobs = pickle.load(state_file)
+        return self._jobs
+
+    def _store(self):
+        if not self.state_filename:
+            return
+        temp_filename = '{}.tmp'.format(self.state_filename)
+        with open(temp_filename, 'wb') as state_file:
+            pickle.dump(self._jobs, state_file)
+        os.rename(temp_filename, self.state_filename)
+
+    def _spool_path(self, job_id):
+        return os.path.join(self.spool_directory, job_id)
+
+    def submit(self, record_name, metadata, piece_name, encryption_key, data=None,
+               records=(), delete_lost=False, on_repaired=None):
+        """Queues the repair of a lost piece of the file recorded as record_name.
+
+        data is the plain content of the piece when it was rebuilt already,
+        otherwise the job rebuilds it from its siblings. records names other
+        files sharing the piece. With delete_lost, the lost copy, still there
+        but corrupt, is deleted once repaired. on_repaired is called with the
+        piece name, the lost file id and the new piece metadata once repaired.
+        Returns the job id, None if the repair could not be recorded anywhere.
+        """
+        if self.metadata_store is None and on_repaired is None:
+            warning("Not repairing {}, its new copy could not be recorded".format(piece_name))
+            return None
+        piece_meta = metadata["pieces"][piece_name]
+        with self._lock:
+            jobs = self._load()
+            for job_id, job in jobs.iteritems():
+                if job["piece"] == piece_name and job["lost_file_id"] == piece_meta["file_id"]:
+                    if on_repaired is not None:
+                        self._callbacks.setdefault(job_id, []).append(on_repaired)
+                    return job_id
+            job_id = uuid.uuid4().hex
+            jobs[job_id] = {
+                "record": record_name,
+                "records": list(records),
+                "piece": piece_name,
+                "group": recovery_manager.recovery_group(piece_name, metadata["pieces"]),
+                "lost_file_id": piece_meta["file_id"],
+                "attempts": 0,
+                "spooled": False,
+                "delete_lost": delete_lost
+            }
+            self._keys[job_id] = encryption_key
+            if data is not None:
+                self._data[job_id] = data
+            if on_repaired is not None:
+                self._callbacks[job_id] = [on_repaired]
+            self._store()
+        info("Queued the repair of {}".format(piece_name))
+        self._schedule(job_id)
+        return job_id
+
+    def resume(self, encryption_key=None):
+        """Restarts the jobs left over by an earlier run or given up on.
+
+        Jobs which did not get to encrypt their piece need its encryption_key.
+        Their callbacks are gone, so they are only resumed with a metadata store.
+        """
+        if self.metadata_store is None:
+            warning("Not resuming the repairs, their new copies could not be recorded")
+            return
+        with self._lock:
+            job_ids = [job_id for job_id in self._load() if job_id not in self._active]
+            for job_id in job_ids:
+                self._jobs[job_id]["attempts"] = 0
+                if encryption_key is not None:
+                    self._keys.setdefault(job_id, encryption_key)
+        for job_id in job_ids:
+            self._schedule(job_id)
+
+    def join(self, timeout=None):
+        """Waits for the queued jobs to be done, returns True if they are."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._active:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                # without a timeout python 2 waits can't be interrupted
+                self._lock.wait(remaining if remaining is not None else 1)
+            return not self._active
+
+    def _schedule(self, job_id, delay=0):
+        with self._lock:
+            self._active.add(job_id)
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers)
+        if not delay:
+            self._pool.submit(self._run, job_id)
+            return
+        timer = threading.Timer(delay, self._pool.submit, (self._run, job_id))
+        timer.daemon = True
+        timer.start()
+
+    def _run(self, job_id):
+        try:
+            self._repair(job_id)
+        except Exception as exc:
+            with self._lock:
+                job = self._jobs[job_id]
+                job["attempts"] += 1
+                self._store()
+                attempts = job["attempts"]
+            if attempts < REPAIR_ATTEMPTS:
+                delay = REPAIR_RETRY_DELAY * 2 ** (attempts - 1)
+                warning("Repair of {} failed with {!r}, retrying in {}s".format(
+                    job["piece"], exc, delay))
+                self._schedule(job_id, delay)
+                return
+            warning("Repair of {} failed with {!r}, giving up until resumed".format(
+                job["piece"], exc))
+            metrics.counter(REPAIRS, outcome='failed').inc()
+            with self._lock:
+                self._active.discard(job_id)
+                self._lock.notify_all()
+            return
+
+        metrics.counter(REPAIRS, outcome='repaired').inc()
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._keys.pop(job_id, None)
+            self._callbacks.pop(job_id, None)
+            self._store()
+            self._active.discard(job_id)
+            self._lock.notify_all()
+
+    def _repair(self, job_id):
+        with self._lock:
+            job = dict(self._jobs[job_id])
+            encryption_key = self._keys.get(job_id)
+        group = job["group"]
+        piece = FilePiece(job["piece"], job["record"], metadata=group[job["piece"]])
+
+        spool_path = self._spool_path(job_id)
+        if job["spooled"]:
+            with open(spool_path, 'rb') as spool_file:
+                piece.payload = spool_file.read()
+        else:
+            if piece.is_cached:
+                # a copy downloaded earlier only needs uploading again
+                piece.download()
+            else:
+                if encryption_key is None:
+                    raise Exception("The encryption key of {} is needed to rebuild it!"
+                                    .format(piece.name))
+                data = self._data.get(job_id)
+                if data is None:
+                    data = recovery_manager.rebuild(piece, {"pieces": group}, encryption_key)
+                piece.data = data
+                piece.encode(encryption_key)
+            piece_cache.make_directory(self.spool_directory)
+            with open('{}.tmp'.format(spool_path), 'wb') as spool_file:
+                spool_file.write(piece.payload)
+            os.rename('{}.tmp'.format(spool_path), spool_path)
+            with self._lock:
+                self._jobs[job_id]["spooled"] = True
+                self._store()
+                self._data.pop(job_id, None)
+
+        if job["attempts"]:
+            # its cloud may be the one failing, move the piece away from its siblings
+            others = set(meta["cloud"] for name, meta in group.iteritems() if name != piece.name)
+            try:
+                piece.cloud = placement.scheduler.choose(piece.size, exclude=others)
+            except Exception:
+                placement.scheduler.book(piece.cloud, piece.size)
+        else:
+            placement.scheduler.book(piece.cloud, piece.size)
+
+        payload = piece.payload
+        with metrics.span('repair', cloud=piece.cloud, size=len(payload)):
+            piece.upload()
+        info("Repaired {} on {}".format(piece.name, piece.cloud))
+        lost_cloud = group[piece.name]["cloud"]
+        if piece_cache.cache:
+            piece_cache.cache.put(piece.cloud, piece.metadata["file_id"], payload)
+            piece_cache.cache.invalidate(lost_cloud, job["lost_file_id"])
+        self._record(job, piece.metadata)
+        with self._lock:
+            callbacks = list(self._callbacks.get(job_id, ()))
+        for on_repaired in callbacks:
+            try:
+                on_repaired(piece.name, job["lost_file_id"], piece.metadata)
+            except Exception as exc:
+                warning("Could not record the repair of {}: {!r}".format(piece.name, exc))
+        os.remove(spool_path)
+        if job.get("delete_lost"):
+            try:
+                CloudFactory.get_cloud(lost_cloud).delete(job["lost_file_id"])
+            except Exception as exc:
+                warning("Could not delete the corrupt copy of {}: {!r}".format(piece.name, exc))
+
+    def _record(self, job, piece_meta):
+        """Points the records and chunks holding a repaired piece at its new copy."""
+        if self.chunk_index is not None:
+            repoint_index(self.chunk_index, job["piece"], job["lost_file_id"], piece_meta)
+        store = self.metadata_store
+        if store is None:
+            return
+        names = [job["record"]] + job.get("records", [])
+        record = store.get(job["record"])
+        if record and "pack" in record:
+            # a pack is shared by the records of all the files packed in it
+            names = store.names()
+
+        changed = False
+        for name in names:
+            record = store.get(name)
+            if record and repoint(record["pieces"], job["piece"], job["lost_file_id"], piece_meta):
+                store.put(name, record, commit=False)
+                changed = True
+        if changed:
+            store.commit()
+
+
+queue = RepairQueue()
+
+
+def set_queue(new_queue):
+    """Plugs in another repair queue, returns the previous one."""
+    global queue
+    previous, queue = queue, new_queue
+    return previous
@@ -0,0 +1,297 @@
+"""Retries, rate limiting and circuit breaking around every call to a cloud.
+
+CloudFactory hands out writers wrapped in a RetryingWriter. Calls failing with
+a transient error (rate limits, 5xx, dropped connections) are retried with
+jittered exponential backoff, waiting at least as long as a Retry-After asks.
+Every cloud gets a token bucket whose rate halves on each rate limit error and
+creeps back up on success, and a circuit breaker that fails calls fast once a
+cloud failed too many times in a row, until it had time to recover.
+"""
+import email.utils
+import random
+import socket
+import threading
+import time
+from logging import warning
+
+import metrics
+from constants import (BREAKER_COOLDOWN, BREAKER_THRESHOLD, RATE_LIMITS, RETRY_ATTEMPTS,
+                       RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+RETRIES = 'sprinkle_retries_total'
+BREAKER_OPENS = 'sprinkle_breaker_opens_total'
+
+# HTTP statuses worth trying again
+RETRIABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+RATE_LIMITED = 429
+
+# Lowest fraction of its configured rate a cloud is slowed down to
+MIN_RATE_FACTOR = 0.05
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a cloud which keeps failing."""
+
+    status = 503
+
+
+def status_of(exc):
+    """Returns the HTTP status of a provider error, None if it has none."""
+    for owner in (exc, getattr(exc, 'resp', None), getattr(exc, 'response', None)):
+        for attribute in ('status', 'status_code'):
+            status = getattr(owner, attribute, None)
+            if isinstance(status, int):
+                return status
+    if type(exc).__name__ == 'RateLimitError':  # dropbox
+        return RATE_LIMITED
+    return None
+
+
+def retry_after(exc):
+    """Returns the seconds a provider error asks to wait, None if it doesn't say."""
+    backoff = getattr(exc, 'backoff', None)  # dropbox RateLimitError
+    if backoff:
+        return float(backoff)
+    for owner in (exc, getattr(exc, 'resp', None), getattr(exc, 'response', None)):
+        headers = getattr(owner, 'headers', None) or (owner if isinstance(owner, dict) else None)
+        if not headers:
+            continue
+        value = headers.get('Retry-After') or headers.get('retry-after')
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            parsed = email.utils.parsedate_tz(value)
+            if parsed:
+                return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+    return None
+
+
+def is_transient(exc):
+    """Tells if a failed call is worth trying again."""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    status = status_of(exc)
+    if status is not None:
+        return status in RETRIABLE_STATUSES
+    if isinstance(exc, (socket.error, httplib.HTTPException)):
+        return True
+    # connection errors and timeouts of requests, which the Dropbox and Box SDKs use
+    return type(exc).__module__.startswith('requests') and \
+        type(exc).__name__ in ('ConnectionError', 'Timeout', 'ConnectTimeout', 'ReadTimeout',
+                               'ChunkedEncodingError')
+
+
+class TokenBucket(object):
+    """Allows rate calls per second on average and bursts of up to burst calls.
+
+    The rate halves on every rate limit error and grows back by a tenth of
+    the configured rate on every success.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = burst or max(1.0, self.max_rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """Waits for tokens, more than the burst are taken once the bucket is full."""
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(tokens, self.burst)
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate / 2)
+
+    def speed_up(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class CircuitBreaker(object):
+    """Opens after threshold failures in a row, lets a trial call through after cooldown."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and \
+                time.time() - self._opened_at < self.cooldown
+
+    def allow(self):
+        """Tells if a call may go through, once cooled down only a single trial call does."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at < self.cooldown or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failed(self):
+        """Records a failure, returns True when it opened the breaker."""
+        with self._lock:
+            self._failures += 1
+            reopened = self._trial
+            self._trial = False
+            if reopened or (self._opened_at is None and self._failures >= self.threshold):
+                self._opened_at = time.time()
+                return True
+            return False
+
+
+class RetryPolicy(object):
+    """Retries, rate limit and circuit breaker of a cloud."""
+
+    def __init__(self, cloud, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, rate=None):
+        self.cloud = cloud
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        rate = rate if rate is not None else RATE_LIMITS.get(cloud)
+        self.bucket = TokenBucket(rate) if rate else None
+        self.breaker = CircuitBreaker()
+
+    def delay(self, attempt, exc):
+        """Seconds to wait before the given retry, full jitter unless told how long."""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        asked = retry_after(exc)
+        return max(asked, backoff) if asked is not None else backoff
+
+    def call(self, operation, func, before_retry=None, tokens=1):
+        """Calls func until it succeeds, fails for good or runs out of attempts.
+
+        before_retry is called ahead of every retry, to rewind streams. tokens
+        is the number of API calls func makes, such as the requests of a batch.
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError('{} keeps failing, not calling it for now'
+                                       .format(self.cloud))
+            if self.bucket:
+                self.bucket.acquire(tokens)
+            try:
+                result = func()
+            except Exception as exc:
+                transient = is_transient(exc)
+                if not transient:
+                    # the cloud answered, ending a trial call as much as a success does
+                    self.breaker.succeeded()
+                elif self.breaker.failed():
+                    warning('Circuit of {} opened after: {!r}'.format(self.cloud, exc))
+                    metrics.counter(BREAKER_OPENS, cloud=self.cloud).inc()
+                if self.bucket and status_of(exc) == RATE_LIMITED:
+                    self.bucket.slow_down()
+                attempt += 1
+                if not transient or attempt >= self.attempts:
+                    raise
+                delay = self.delay(attempt, exc)
+                warning('{} on {} failed with {!r}, retrying in {:.2f}s'.format(
+                    operation, self.cloud, exc, delay))
+                metrics.counter(RETRIES, cloud=self.cloud, operation=operation).inc()
+                time.sleep(delay)
+                if before_retry:
+                    before_retry()
+                continue
+            self.breaker.succeeded()
+            if self.bucket:
+                self.bucket.speed_up()
+            return result
+
+
+class _CountingWriter(object):
+    """Counts the bytes written through it, so a download can resume after them."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.written = 0
+
+    def write(self, data):
+        self.handle.write(data)
+        self.written += len(data)
+
+
+class RetryingWriter(object):
+    """Wraps a CloudWriter, running its calls through a RetryPolicy.
+
+    Uploads rewind their stream before a retry, resumable sessions pick up
+    where they stopped. Downloads resume after the bytes already delivered.
+    Calls answered from the cached listing of the writer are not throttled,
+    the writer runs the calls it makes on a cache miss through the policy.
+    """
+
+    RETRIED = ('upload', 'upload_stream', 'delete', 'list', 'list_base_folder', 'free_space')
+
+    def __init__(self, writer, policy=None):
+        self.__dict__['writer'] = writer
+        self.__dict__['policy'] = policy or RetryPolicy(writer.name)
+        writer.retry_policy = self.policy
+
+    def __getattr__(self, name):
+        attribute = getattr(self.writer, name)
+        if name not in self.RETRIED:
+            return attribute
+        if name == 'upload_stream':
+            return self._upload_stream
+
+        def retried(*args, **kwargs):
+            return self.policy.call(name, lambda: attribute(*args, **kwargs))
+        return retried
+
+    def __setattr__(self, name, value):
+        setattr(self.writer, name, value)
+
+    def _upload_stream(self, name, stream, *args, **kwargs):
+        start = stream.tell()
+        return self.policy.call('upload_stream',
+                                lambda: self.writer.upload_stream(name, stream, *args, **kwargs),
+                                before_retry=lambda: stream.seek(start))
+
+    def download(self, file_id, local_file_handle, offset=0, length=None, chunk_size=None):
+        counter = _CountingWriter(local_file_handle)
+
+        def download():
+            remaining = None if length is None else length - counter.written
+            if remaining == 0:
+                return
+            self.writer.download(file_id, counter, offset=offset + counter.written,
+                                 length=remaining, chunk_size=chunk_size)
+        return self.policy.call('download', download)
@@ -0,0 +1,198 @@
+"""Background scrubbing of the pieces of every sprinkled file.
+
+A pass goes over every record of the metadata store and checks, one bulk call
+per batch of file ids, that each cloud still holds its pieces. With verify,
+pieces are also read back to compare their SHA-256 with the checksum recorded
+at upload. The hashes the providers keep (MD5 on Drive, SHA-1 on Box, block
+hashes on Dropbox) can't be compared to it without the content.
+
+Lost and corrupt pieces go to the repair queue, which rebuilds them from
+their siblings and records them in the same metadata store. File ids checked
+and bytes read are rate limited, leaving the clouds to foreground transfers.
+
+    queue = RepairQueue(metadata_store=metadata_store)
+    scrubber = Scrubber(metadata_store, encryption_key, queue=queue)
+    report = scrubber.scrub()
+    scrubber.start()
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from logging import info, warning
+
+import metrics
+import repair_queue
+from cloud_io import CloudFactory
+from constants import (SCRUB_BATCH_SIZE, SCRUB_BYTES_PER_SECOND, SCRUB_CALLS_PER_SECOND,
+                       SCRUB_INTERVAL)
+from file_models.sprinkle_file import pad_key
+from retry import TokenBucket
+
+SCRUBBED = 'sprinkle_scrub_pieces_total'
+
+# Outcomes of checking a piece
+OK = 'ok'
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+UNCHECKED = 'unchecked'
+
+
+class _HashingWriter(object):
+    """Hashes what is written to it, reading no faster than its bucket allows."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.bucket.acquire(len(data))
+        self.sha256.update(data)
+        self.size += len(data)
+
+
+class Scrubber(object):
+    """Finds lost and corrupt pieces and queues their repair."""
+
+    def __init__(self, metadata_store, encryption_key, verify=False, interval=SCRUB_INTERVAL,
+                 batch_size=SCRUB_BATCH_SIZE, calls_per_second=SCRUB_CALLS_PER_SECOND,
+                 bytes_per_second=SCRUB_BYTES_PER_SECOND, queue=None):
+        self.metadata_store = metadata_store
+        # repairs go to this queue, or like those of downloads to the global one of the time
+        if queue is not None and queue.metadata_store is not metadata_store:
+            raise Exception('The repair queue does not record into the scrubbed metadata store!')
+        self.queue = queue
+        self.encryption_key = pad_key(encryption_key)
+        self.verify = verify
+        self.interval = interval
+        self.batch_size = batch_size
+        self._calls = TokenBucket(calls_per_second)
+        self._bytes = TokenBucket(bytes_per_second)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        # counts of the pass under way, or of the last one
+        self.progress = {}
+
+    def start(self):
+        """Keeps scrubbing in a background thread, a pass every interval seconds."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='scrubber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops scrubbing, ending the pass under way after its current batch."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.scrub()
+            except Exception as exc:
+                warning('Scrubbing failed with {!r}'.format(exc))
+            self._stop.wait(self.interval)
+
+    def _pieces(self):
+        """Maps (cloud, file id) of every piece to its name and the records holding it."""
+        pieces = OrderedDict()
+        for name in self.metadata_store.names():
+            record = self.metadata_store.get(name)
+            if not record:
+                continue
+            for piece_name, piece_meta in sorted(record["pieces"].iteritems()):
+                key = (piece_meta["cloud"], piece_meta["file_id"])
+                entry = pieces.setdefault(key, {"piece": piece_name, "meta": piece_meta,
+                                                "metadata": record, "records": []})
+                entry["records"].append(name)
+        return pieces
+
+    def scrub(self):
+        """Checks every piece once and queues the repairs, returns the counts of the pass."""
+        self.metadata_store.sync()
+        pieces = self._pieces()
+        with self._lock:
+            self.progress = {"pieces": len(pieces), "checked": 0, OK: 0, MISSING: 0,
+                             CORRUPT: 0, UNCHECKED: 0, "queued": 0, "started": time.time()}
+
+        file_ids_by_cloud = OrderedDict()
+        for cloud, file_id in pieces:
+            file_ids_by_cloud.setdefault(cloud, []).append(file_id)
+
+        info('Scrubbing {} pieces on {} clouds...'.format(len(pieces), len(file_ids_by_cloud)))
+        with metrics.span('scrub'):
+            for cloud, file_ids in file_ids_by_cloud.iteritems():
+                # listings cached by earlier calls may predate a loss
+                CloudFactory.get_cloud(cloud).invalidate_listing()
+                for start in xrange(0, len(file_ids), self.batch_size):
+                    if self._stop.is_set():
+                        break
+                    self._scrub_batch(cloud, file_ids[start:start + self.batch_size], pieces)
+                    info('Scrubbed {checked} of {pieces} pieces, {missing} missing, '
+                         '{corrupt} corrupt'.format(**self.progress))
+
+        with self._lock:
+            self.progress["seconds"] = time.time() - self.progress["started"]
+            return dict(self.progress)
+
+    def _scrub_batch(self, cloud, file_ids, pieces):
+        cloud_conn = CloudFactory.get_cloud(cloud)
+        # clouds such as Drive check every file id with a request of its own
+        self._calls.acquire(len(file_ids))
+        try:
+            exists = cloud_conn.exists_many(file_ids)
+        except Exception as exc:
+            warning('Could not check the pieces on {}: {!r}'.format(cloud, exc))
+            exists = None
+
+        for file_id in file_ids:
+            entry = pieces[(cloud, file_id)]
+            if exists is None:
+                outcome = UNCHECKED
+            elif not exists.get(file_id):
+                outcome = MISSING
+            elif self.verify:
+                outcome = self._verify(cloud_conn, file_id, entry)
+            else:
+                outcome = OK
+
+            metrics.counter(SCRUBBED, cloud=cloud, outcome=outcome).inc()
+            queued = outcome in (MISSING, CORRUPT) and self._repair(entry, outcome)
+            with self._lock:
+                self.progress["checked"] += 1
+                self.progress[outcome] += 1
+                self.progress["queued"] += 1 if queued else 0
+
+    def _verify(self, cloud_conn, file_id, entry):
+        """Reads a piece back and compares it with its checksum."""
+        checksum = entry["meta"].get("checksum")
+        if not checksum:
+            # uploaded before pieces had checksums
+            return OK
+        digest = _HashingWriter(self._bytes)
+        self._calls.acquire()
+        try:
+            with metrics.span('verify', cloud=cloud_conn.name) as span:
+                cloud_conn.download(file_id, digest)
+                span['size'] = digest.size
+        except Exception as exc:
+            warning('Could not read {} back: {!r}'.format(entry["piece"], exc))
+            return UNCHECKED
+        return OK if digest.sha256.hexdigest() == checksum else CORRUPT
+
+    def _repair(self, entry, outcome):
+        """Queues the repair of a lost or corrupt piece, returns True if it was queued."""
+        queue = self.queue if self.queue is not None else repair_queue.queue
+        if queue is None or queue.metadata_store is not self.metadata_store:
+            warning('{} is {}, no repair queue records into the scrubbed metadata store'
+                    .format(entry["piece"], outcome))
+            return False
+        warning('{} is {}, queueing its repair'.format(entry["piece"], outcome))
+        job_id = queue.submit(entry["records"][0], entry["metadata"], entry["piece"],
+                              self.encryption_key, records=entry["records"][1:],
+                              delete_lost=outcome == CORRUPT)
+        return job_id is not None
@@ -2,8 +2,11 @@ import pprint
 import random
 import time
 
-from cloud_io import CloudFactory, Metadata
+from cloud_io import ChunkIndex, CloudFactory
+from file_models.sprinkle_batch import SprinkleBatch
 from file_models.sprinkle_file import SprinkleFile
+from metadata_store import MetadataStore
+import repair_queue
 
 
 if __name__ == '__main__':
@@ -26,12 +29,16 @@ if __name__ == '__main__':
 
     # upload
     metadata = {}
-    for source_file in source_files:
-        sfile = SprinkleFile(source_file, encryption_key=encryption_key)
-        sfile.upload()
-        metadata = Metadata.load()
-        metadata[source_file] = sfile.metadata
-        Metadata.store(metadata)
+    metadata_store = MetadataStore()
+    metadata_store.sync()
+    repair_queue.set_queue(repair_queue.RepairQueue(metadata_store=metadata_store))
+    repair_queue.queue.resume(encryption_key)
+    chunk_index = ChunkIndex.load()
+    batch = SprinkleBatch(source_files, encryption_key=encryption_key,
+                          metadata_store=metadata_store, chunk_index=chunk_index,
+                          skip_unchanged=False)
+    metadata.update(batch.upload())
+    ChunkIndex.store(chunk_index)
 
     print("*"*20)
     print("File metadata")
@@ -47,9 +54,10 @@ if __name__ == '__main__':
         CloudFactory.get_cloud(piece_meta["cloud"]).delete(piece_meta["file_id"])
 
     # download
+    metadata_store.sync()
     for source_file in source_files:
-        metadata = Metadata.load()
-
-        dfile = SprinkleFile(source_file, metadata=metadata[source_file],
+        dfile = SprinkleFile(source_file, metadata=metadata_store[source_file],
                              encryption_key=encryption_key)
         dfile.download()
+    # lost pieces are uploaded again in the background, recording their new file ids
+    repair_queue.queue.join()
@@ -0,0 +1,29 @@
+import io
+import os
+import random
+import unittest
+
+import chunking
+from constants import CDC_MAX_SIZE, CDC_MIN_SIZE
+
+
+class CutPointTest(unittest.TestCase):
+
+    @unittest.skipIf(chunking.numpy is None, 'numpy is not installed')
+    def test_numpy_and_python_cut_the_same(self):
+        sizes = random.Random(0).sample(xrange(CDC_MIN_SIZE + 1, CDC_MAX_SIZE * 2), 8)
+        for size in sizes:
+            data = os.urandom(size)
+            end = min(len(data), CDC_MAX_SIZE)
+            self.assertEqual(chunking._find_cut_numpy(data, CDC_MIN_SIZE, end),
+                             chunking._find_cut_python(data, CDC_MIN_SIZE, end))
+
+    def test_chunks_cover_the_data(self):
+        data = os.urandom(3 * CDC_MAX_SIZE)
+        chunks = list(chunking.iter_chunks(io.BytesIO(data)))
+        self.assertEqual(b''.join(chunk for _, chunk in chunks), data)
+        self.assertTrue(all(len(chunk) <= CDC_MAX_SIZE for _, chunk in chunks))
+
+
+if __name__ == '__main__':
+    unittest.main()